@@ -0,0 +1,274 @@
+"""
+learn the structure of build flows from the observed runs
+"""
+import os
+import threading
+import logging
+from collections import OrderedDict
+import yaml
+from reflatus.loader import Loader
+
+
+# the maximum number of root flow runs being observed at the same time
+MAX_OBSERVED_RUNS = 100
+
+
+class FlowRun(object):
+    """
+    the jobs observed during a single run of a root flow
+    """
+    def __init__(self, name, build, started):
+        self.name = name
+        self.build = build
+        self.started = started
+        self.jobs = OrderedDict()
+
+    def observe(self, name, build, status, timestamp, started=None):
+        """
+        record the started/finalized event of a downstream job
+        @param started: the start timestamp, if known before this event
+        """
+        key = (name, build["number"])
+        job = self.jobs.get(key, None)
+        if job is None:
+            job = self.jobs[key] = dict(name=name,
+                                        parameters=build.get("parameters"),
+                                        started=started or timestamp,
+                                        finished=None)
+        job["build"] = build
+        job["status"] = status
+        if status != "running":
+            job["finished"] = timestamp
+
+    def learn(self):
+        """
+        infer the serial/parallel stages from the start/finish timestamps
+        A job joins the current stage if it started before all the jobs
+        of the current stage finished, otherwise it starts a new stage.
+        @return: the jobs in flows.yaml format
+        """
+        stages = list()
+        stage_end = None
+        for job in sorted(self.jobs.values(), key=lambda j: j["started"]):
+            finished = job["finished"]
+            if finished is None:
+                finished = float("inf")
+            if stages and job["started"] < stage_end:
+                stages[-1].append(job)
+                stage_end = max(stage_end, finished)
+            else:
+                stages.append([job])
+                stage_end = finished
+
+        identifiers = self._getIdentifiers()
+        jobs = list()
+        for stage in stages:
+            subjobs = list()
+            for job in stage:
+                subjob = dict(name=job["name"])
+                identifier = identifiers.get(job["name"], None)
+                if identifier:
+                    subjob["identifier"] = dict((key, job["parameters"][key])
+                                                for key in identifier)
+                subjobs.append(subjob)
+
+            if len(subjobs) > 1:
+                jobs.append(dict(parallel=subjobs))
+            elif jobs and "serial" in jobs[-1]:
+                jobs[-1]["serial"].extend(subjobs)
+            else:
+                jobs.append(dict(serial=subjobs))
+        return jobs
+
+    def _getIdentifiers(self):
+        """
+        find the parameters distinguishing the jobs triggered several times
+        @return: a dict of job name and its identifying parameter names
+        """
+        parameters = dict()
+        for job in self.jobs.values():
+            parameters.setdefault(job["name"], list()).append(
+                job["parameters"] or dict())
+
+        identifiers = dict()
+        for (name, params_list) in parameters.iteritems():
+            if len(params_list) < 2:
+                continue
+            keys = set()
+            for params in params_list:
+                keys.update(params.keys())
+            identifiers[name] = sorted(
+                key for key in keys
+                if all(key in params for params in params_list) and
+                len(set(repr(params[key]) for params in params_list)) > 1)
+        return identifiers
+
+
+class FlowDiscoverer(object):
+    """
+    discover the structure of the flows which are not configured
+    in the flows' configuration file
+    """
+    log = logging.getLogger('discovery.FlowDiscoverer')
+
+    def __init__(self, cache_path, flows, flow_map):
+        """
+        @param cache_path: the yaml file storing the learned flows
+        @param flows: the configured flows, updated in place
+        @param flow_map: the configured flow maps, updated in place
+        """
+        self.cache_path = cache_path
+        self.flows = flows
+        self.flow_map = flow_map
+        self.configured = set(flows.keys())
+        self.lock = threading.Lock()
+        self.runs = OrderedDict()
+        self.learned = dict()
+        self._changed = False
+        self._load()
+
+    def _load(self):
+        """
+        load the learned flows of the previous runs
+        """
+        if not os.path.exists(self.cache_path):
+            return
+
+        self.log.info("Load discovered flows from %s" % self.cache_path)
+        try:
+            loader = Loader(self.cache_path)
+            (flows, flow_map) = loader.getConfig()
+            learned = dict((flow['name'], flow['jobs'])
+                           for flow in loader.original_data.get('flows',
+                                                                None) or list()
+                           if flow['name'] not in self.configured)
+        except Exception as excp:
+            self.log.error("Unable to load discovered flows from %s: %s"
+                           % (self.cache_path, excp))
+            return
+
+        for (name, jobs) in learned.iteritems():
+            self.learned[name] = jobs
+            self.flows[name] = flows[name]
+            self.flow_map[name] = flow_map[name]
+
+    def isDiscoverable(self, flow_name):
+        """
+        only the flows not in the configuration file are discovered
+        """
+        return flow_name not in self.configured
+
+    def observeFlow(self, name, build, status, timestamp):
+        """
+        observe the started/finalized event of a root flow
+        """
+        if not self.isDiscoverable(name):
+            return
+
+        key = (name, build["number"])
+        with self.lock:
+            if status == "running":
+                run = self._getRun(key)
+                run.build = build
+                run.started = timestamp
+                return
+
+            run = self.runs.pop(key, None)
+
+        # skip the runs which started before being observed
+        if run is None or run.started is None or not run.jobs:
+            return
+        self._learn(run, status, timestamp)
+
+    def observeJob(self, root_name, root_build, name, build, status,
+                   timestamp, started=None):
+        """
+        observe the started/finalized event of a downstream job
+        """
+        if not self.isDiscoverable(root_name):
+            return
+
+        with self.lock:
+            run = self._getRun((root_name, root_build))
+            run.observe(name, build, status, timestamp, started)
+
+    def _getRun(self, key):
+        """
+        get the observed run, the events of a root flow and its jobs
+        may be handled in any order
+        """
+        run = self.runs.get(key, None)
+        if run is None:
+            run = self.runs[key] = FlowRun(key[0], None, None)
+            while len(self.runs) > MAX_OBSERVED_RUNS:
+                self.runs.popitem(last=False)
+        return run
+
+    def _learn(self, run, status, timestamp):
+        """
+        learn the structure of a finished flow run
+        and publish it if it has changed
+        The flow is built in memory, the cache file is written by flush(),
+        since the events are handled under a global lock.
+        """
+        jobs = run.learn()
+        with self.lock:
+            if self.learned.get(run.name, None) == jobs:
+                return
+            self.log.info("Discovered new structure of Flow <%s>" % run.name)
+            self.learned[run.name] = jobs
+            self._changed = True
+
+        try:
+            data = dict(flows=[dict(name=run.name, jobs=jobs)])
+            (flows, flow_map) = \
+                Loader(self.cache_path).getConfigFromData(data)
+        except Exception as excp:
+            self.log.error("Unable to load discovered Flow <%s>: %s"
+                           % (run.name, excp))
+            return
+
+        flow = flows.get(run.name, None)
+        if flow is None:
+            return
+        self._applyRun(flow, run, status, timestamp)
+        self.flows[run.name] = flow
+        self.flow_map[run.name] = flow_map[run.name]
+
+    def _applyRun(self, flow, run, status, timestamp):
+        """
+        fill the new flow with the state of the observed run
+        """
+        flow.build = run.build
+        flow.status = status
+        flow.duration = timestamp - run.started
+        flow.summary.flowChanged(run.build, "running", run.started)
+        flow.summary.flowChanged(run.build, status, timestamp)
+        for job in run.jobs.values():
+            for instance in flow.index.get(job["name"], list()):
+                identifier = instance.identifier or dict()
+                parameters = job["parameters"] or dict()
+                if all(parameters.get(key) == value
+                       for (key, value) in identifier.iteritems()):
+                    finished = job["finished"] or timestamp
+                    instance.update(job["build"],
+                                    job["status"],
+                                    finished - job["started"])
+                    break
+
+    def flush(self):
+        """
+        write the learned flows into the cache file
+        """
+        with self.lock:
+            if self._changed:
+                self._dump()
+                self._changed = False
+
+    def _dump(self):
+        data = dict(flows=[dict(name=name, jobs=jobs)
+                           for (name, jobs) in sorted(self.learned.items())])
+        tmp_path = "%s.%d.tmp" % (self.cache_path, os.getpid())
+        with open(tmp_path, 'w') as cache_file:
+            yaml.safe_dump(data, cache_file, default_flow_style=False)
+        os.rename(tmp_path, self.cache_path)
@@ -4,13 +4,35 @@ This events.py focuses on listening and handling events
 import zmq
 import threading
 from six.moves import queue as Queue
-from reflatus.utils import StoppedException
+from reflatus.utils import StoppedException, JenkinsUnavailableException
+from reflatus.scheduler import Event, FlowGates, Watermarks
+from reflatus.scheduler import ROOT_FLOW, FINALIZED, STARTED, STOPPED
+from reflatus.scheduler import PHASES
+from reflatus.state import JobInstance
 import logging
-import json
+import itertools
+import collections
+import heapq
+import time
 from abc import ABCMeta, abstractmethod
-import re
 
 
+# the timeout (in milliseconds) of polling the zmq socket,
+# which bounds how long stopping the listener takes
+POLL_TIMEOUT = 500
+
+# the seconds an event waits for the cleanup of its root flow
+GATE_TIMEOUT = 60
+
+# the maximum number of event threads running at the same time
+MAX_THREADS = 32
+# the queue size above which the starts of jobs are shed
+MAX_QUEUE = 10000
+# the maximum number of builds waiting for their durations from jenkins
+MAX_DEGRADED = 10000
+# the seconds between the attempts to enrich the degraded builds
+ENRICH_INTERVAL = 5
+
 STATUS_MAP = {"SUCCESS": "success",
               "FAILURE": "failure",
               "ABORTED": "aborted",
@@ -24,37 +46,64 @@ class ZMQListener(threading.Thread):
     """
     log = logging.getLogger('events.ZMQListener')
 
-    def __init__(self, name, addr, jenkinsmgr, flows):
+    def __init__(self, name, addr, jenkinsmgr, flows, discoverer=None,
+                 publisher=None, handler=None, journal=None, stats=None):
         """
         @param name: the name of the zmq
         @param addr: the address of the zmq
         @param jenkinsmgr: JenkinsManager instance
         @param flows: flows object
+        @param discoverer: FlowDiscoverer instance, None to disable discovery
+        @param publisher: FlowStatePublisher instance, None to disable
+                          republishing the flow states
+        @param handler: the events handler, an EventsHandler by default
+        @param journal: Journal instance, None to disable journaling
+        @param stats: DurationStats instance, None to disable the statistics
         """
         threading.Thread.__init__(self, name=name)
+        self.daemon = True
         self.addr = addr
         self.name = name
         self._context = zmq.Context()
         self.socket = self._context.socket(zmq.SUB)
         self._stopped = False
-        self.handler = EventsHandler('%s-handler' % self.name,
-                                     jenkinsmgr,
-                                     flows)
+        self.journal = journal
+        if handler is None:
+            handler = EventsHandler('%s-handler' % self.name,
+                                    jenkinsmgr,
+                                    flows,
+                                    discoverer,
+                                    publisher,
+                                    stats=stats)
+        self.handler = handler
 
     def run(self):
         self._setup_socket()
         self.handler.start()
         self.log.debug('ZMQListenner %s Starts Listening' % self.name)
-        while not self._stopped:
-            event = self.socket.recv().decode('utf-8')
-            self.handler.submitEvent(event)
-            self.log.debug(event)
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        try:
+            while not self._stopped:
+                if not poller.poll(POLL_TIMEOUT):
+                    continue
+                event = self.socket.recv().decode('utf-8')
+                received = time.time()
+                if self.journal:
+                    self.journal.recordEvent(event, received)
+                self.handler.submitEvent(event, received)
+                self.log.debug(event)
+        finally:
+            # the socket can only be closed by the thread using it
+            self.log.debug('ZMQListenner %s Stops Listening' % self.name)
+            self.socket.close(linger=0)
+            self._context.term()
 
     def stop(self):
+        """
+        stop listening, which takes effect within POLL_TIMEOUT
+        """
         self._stopped = True
-        if self._context:
-            self.log.debug('ZMQListenner %s Stops Listening' % self.name)
-            self._context.destroy()
 
     def _setup_socket(self):
         self.log.debug('Setup Socket for ZMQListenner %s' % self.name)
@@ -65,69 +114,356 @@ class ZMQListener(threading.Thread):
 class EventsHandler(threading.Thread):
     """
     events handler
+
+    The events are dispatched by priority: root flow starts first, then
+    finalizations, then starts of jobs. The events of a root flow wait
+    for its cleanup in their own threads, and the events waiting for a
+    free thread slot are deferred by priority, so the handler never blocks.
     """
     log = logging.getLogger("events.EventsHandler")
 
-    def __init__(self, name, jenkinsmgr, flows):
+    def __init__(self, name, jenkinsmgr, flows, discoverer=None,
+                 publisher=None, external=None, stats=None):
+        """
+        @param external: the root flows handled by the other workers
+        @param stats: DurationStats instance, None to disable the statistics
+        """
         threading.Thread.__init__(self, name=name)
-        self.queue = Queue.Queue()
+        self.daemon = True
+        self.queue = Queue.PriorityQueue()
         self.lock = threading.Lock()
         self.name = name
         self.jenkinsmgr = jenkinsmgr
         self.flows = flows
+        self.discoverer = discoverer
+        self.publisher = publisher
+        self.external = external or frozenset()
+        self.stats = stats
+        self.gates = FlowGates()
+        self.watermarks = Watermarks()
+        for (flow_name, flow) in flows.items():
+            self.watermarks.register(flow_name, getattr(flow, 'index', ()))
+        # the queued started events, superseded by their finalized events,
+        # shared by the listener and the handler threads
+        self.pending = dict()
+        self.pending_lock = threading.Lock()
+        self.threads = list()
+        self.slots = threading.BoundedSemaphore(MAX_THREADS)
+        # the heap of the event threads waiting for a slot,
+        # (priority, sequence, event thread), only used by the handler
+        self.deferred = list()
+        # the builds updated without jenkins,
+        # (flow name, target, job name, number)
+        self.degraded = collections.deque(maxlen=MAX_DEGRADED)
+        # the job events handled without their causes, by build,
+        # handled again to resolve their flows once jenkins recovers
+        self.unresolved = collections.OrderedDict()
+        self.unresolved_lock = threading.Lock()
+        self._enricher = None
+        self._enriched = 0
+        self.shed = 0
+        self._sequence = itertools.count()
         self._stopped = False
+        self._deadline = None
 
     def run(self):
         self.log.debug('Handler %s Starts Handling Events' % self.name)
-        while not self._stopped:
-            event = self.queue.get()
+        dropped = 0
+        while True:
+            self._startEnricher()
+            self._startDeferred()
+            if self.deferred and self._deadline and \
+                    time.time() > self._deadline:
+                dropped += len(self.deferred)
+                del self.deferred[:]
+            # the stopped handler only waits for the deferred events
+            timeout = POLL_TIMEOUT / 1000.0 if self._stopped \
+                else ENRICH_INTERVAL
+            if self._deadline:
+                timeout = max(0, min(timeout, self._deadline - time.time()))
+            try:
+                (_, _, event) = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                if self._stopped and not self.deferred:
+                    break
+                continue
             if not event:
+                # stopped, or woken up by a released slot
+                if self._stopped and not self.deferred and \
+                        self.queue.empty():
+                    break
                 continue
-            self.handle_event(event)
+            if self._deadline and time.time() > self._deadline:
+                dropped += 1
+                continue
+            try:
+                self.handle_event(event)
+            except Exception as excp:
+                self.log.exception("Handler %s failed to handle %r: %s"
+                                   % (self.name, event, excp))
 
-    def stop(self):
+        if dropped:
+            self.log.warning("Handler %s dropped %d queued events."
+                             % (self.name, dropped))
+        self._joinThreads()
+        self.log.debug('Handler %s Stops Handling Events' % self.name)
+
+    def stop(self, deadline=None):
+        """
+        stop accepting events, the queued events and the running
+        event threads are drained until the deadline
+        @param deadline: the timestamp to give up draining, None for never
+        """
         self._stopped = True
-        self.queue.put(None)
+        self._deadline = deadline
+        self._put(STOPPED, None)
+
+    def _put(self, priority, event):
+        # the sequence keeps the events of the same priority in order
+        self.queue.put((priority, next(self._sequence), event))
+
+    def _startThread(self, event_thread):
+        """
+        start an event thread, or defer it until a slot is free
+        at most MAX_THREADS event threads run at the same time, except
+        the cleanups of the root flows which the others may wait for
+        """
+        if event_thread.gated:
+            self._spawn(event_thread)
+            return
+        if event_thread.event.topic == 'onFinalized':
+            priority = FINALIZED
+        else:
+            priority = STARTED
+        heapq.heappush(self.deferred,
+                       (priority, next(self._sequence), event_thread))
+        self._startDeferred()
+
+    def _startDeferred(self):
+        """
+        start the deferred event threads by priority while slots are free
+        """
+        while self.deferred and self.slots.acquire(False):
+            (_, _, event_thread) = heapq.heappop(self.deferred)
+            try:
+                self._spawn(event_thread)
+            except Exception as excp:
+                self.log.exception("Handler %s failed to start %r: %s"
+                                   % (self.name, event_thread.event, excp))
 
-    def submitEvent(self, event):
+    def releaseSlot(self):
+        """
+        release the slot of a finished event thread, and wake up
+        the handler to start the deferred ones
+        """
+        self.slots.release()
+        if self.deferred:
+            self._put(ROOT_FLOW, None)
+
+    def _spawn(self, event_thread):
+        """
+        start an event thread holding a slot or a gate,
+        and keep track of it for draining
+        """
+        self.threads = [thread for thread in self.threads
+                        if thread.is_alive()]
+        try:
+            event_thread.start()
+        except Exception:
+            # e.g. unable to start a new thread
+            if event_thread.gated:
+                self.gates.open(event_thread.name)
+            else:
+                self.slots.release()
+            raise
+        self.threads.append(event_thread)
+
+    def enrich(self, flow_name, target, name, number):
+        """
+        fetch the duration of a build later, when jenkins is available
+        @param flow_name: the root flow of the target
+        @param target: the job instance or the flow updated by the build
+        """
+        self.degraded.append((flow_name, target, name, number))
+
+    def hold(self, event):
+        """
+        handle a job event again once jenkins is available,
+        to resolve the flow it belongs to from its causes
+        """
+        with self.unresolved_lock:
+            held = self.unresolved.get(event.key, None)
+            if held is not None and held.topic == 'onFinalized':
+                # the build already finished
+                return
+            self.unresolved[event.key] = event
+            if len(self.unresolved) > MAX_DEGRADED:
+                self.unresolved.popitem(last=False)
+
+    def _resolve(self):
+        """
+        queue again the job events held in degraded mode
+        """
+        with self.unresolved_lock:
+            held = self.unresolved.values()
+            self.unresolved.clear()
+        if not held:
+            return
+        self.log.info("Resolve %d job events handled in degraded mode."
+                      % len(held))
+        for event in held:
+            phase = self.watermarks.getPhase(event.name,
+                                             event.build["number"])
+            if phase and phase > PHASES[event.topic]:
+                # the start of a build finished meanwhile
+                continue
+            if event.topic == 'onFinalized':
+                self._put(FINALIZED, event)
+            else:
+                self._put(STARTED, event)
+
+    def _startEnricher(self):
+        if not (self.degraded or self.unresolved) or \
+                not self.jenkinsmgr.available:
+            return
+        if self._enricher and self._enricher.is_alive():
+            return
+        if time.time() - self._enriched < ENRICH_INTERVAL:
+            return
+        self._enriched = time.time()
+        self._enricher = threading.Thread(target=self._enrich,
+                                          name="%s-enricher" % self.name)
+        self._enricher.daemon = True
+        self._enricher.start()
+
+    def _enrich(self):
+        """
+        fetch the durations of the builds updated in degraded mode,
+        and resolve the flows of the job events handled meanwhile
+        """
+        if not self._stopped:
+            self._resolve()
+        if self.degraded:
+            self.log.info("Enrich %d builds updated in degraded mode."
+                          % len(self.degraded))
+        while self.degraded and not self._stopped:
+            entry = self.degraded.popleft()
+            (flow_name, target, name, number) = entry
+            try:
+                duration = self.jenkinsmgr.getDuration(name, number)
+            except Exception as excp:
+                self.log.warning("Unable to enrich <%s/%s>: %s"
+                                 % (name, number, excp))
+                self.degraded.appendleft(entry)
+                return
+            with self.lock:
+                build = target.build
+                if not build or build["number"] != number:
+                    continue
+                target.duration = duration.total_seconds()
+                isjob = isinstance(target, JobInstance)
+                if isjob and self.stats:
+                    self.stats.observe(flow_name, target, target.duration)
+                if not self.publisher:
+                    continue
+                if isjob:
+                    self.publisher.publishJob(flow_name, target)
+                else:
+                    self.publisher.publishFlow(flow_name, target)
+
+    def _joinThreads(self):
+        """
+        wait for the running event threads until the deadline
+        """
+        for thread in self.threads:
+            if self._deadline is None:
+                thread.join()
+            else:
+                thread.join(max(0, self._deadline - time.time()))
+        running = len([thread for thread in self.threads
+                       if thread.is_alive()])
+        if running:
+            self.log.warning("Handler %s abandoned %d running events."
+                             % (self.name, running))
+
+    def submitEvent(self, event, received=None):
+        """
+        parse and queue a raw zmq event by its priority
+        @param received: the timestamp receiving the event, now by default
+        """
         if self._stopped:
             raise StoppedException("Handler %s is no longer running"
                                    % self.name)
-        self.queue.put(event)
+        try:
+            event = Event.parse(event, received or time.time())
+        except Exception as excp:
+            self.log.error("Unable to parse event %r: %s" % (event, excp))
+            return
 
-    def handle_event(self, event):
-        pattern = re.compile(r"(on\w+) (\{.*\})", re.DOTALL)
-        topic, data = pattern.match(event).groups()
+        if event.topic not in ('onStarted', 'onFinalized'):
+            return
 
-        if topic == 'onStarted':
-            self._handle_started_event(data)
-        elif topic == 'onCompleted':
-            pass
-        elif topic == 'onFinalized':
-            self._handle_finalized_event(data)
+        # drop the stale events before any thread or jenkins request
+        flow = self.flows.get(event.name, None)
+        isroot = flow is not None
+        if not self.watermarks.observe(event, isroot,
+                                       getattr(flow, 'index', None)):
+            self.log.debug("%r is out-dated. Ignore it." % event)
+            return
+
+        if event.topic == 'onStarted':
+            if isroot:
+                priority = ROOT_FLOW
+            elif self.queue.qsize() + len(self.deferred) >= MAX_QUEUE:
+                # shed the least important events when overloaded
+                self.shed += 1
+                if self.shed % 1000 == 1:
+                    self.log.warning("Handler %s is overloaded, %d starts "
+                                     "of jobs shed." % (self.name, self.shed))
+                return
+            else:
+                priority = STARTED
+                with self.pending_lock:
+                    self.pending[event.key] = event
+        elif event.topic == 'onFinalized':
+            priority = FINALIZED
+            with self.pending_lock:
+                started = self.pending.pop(event.key, None)
+            if started is not None:
+                # the build finished before its start was handled
+                started.superseded = True
+                event.started = started.received
+        self._put(priority, event)
 
-    def _handle_started_event(self, data):
+    def handle_event(self, event):
+        if event.topic == 'onStarted':
+            with self.pending_lock:
+                if self.pending.get(event.key, None) is event:
+                    self.pending.pop(event.key, None)
+            if event.superseded:
+                self.log.debug("%r is superseded. Ignore it." % event)
+                return
+            self._handle_started_event(event)
+        elif event.topic == 'onFinalized':
+            self._handle_finalized_event(event)
+
+    def _handle_started_event(self, event):
         """
         handle started event
         """
-        event_thread = StartedEventThread(data,
-                                          self.jenkinsmgr,
-                                          self.flows,
-                                          self.lock)
-        event_thread.start()
-        if event_thread.isrootflow:
-            self.log.debug("Waiting for cleanup.")
-            event_thread.join()
+        event_thread = StartedEventThread(event, self)
+        if event.name in self.flows:
+            # the other events of the flow wait for the cleanup
+            self.gates.close(event.name)
+            event_thread.gated = True
+        self._startThread(event_thread)
 
-    def _handle_finalized_event(self, data):
+    def _handle_finalized_event(self, event):
         """
         handle finalized event
         """
-        event_thread = FinalizedEventThread(data,
-                                            self.jenkinsmgr,
-                                            self.flows,
-                                            self.lock)
-        event_thread.start()
+        event_thread = FinalizedEventThread(event, self)
+        self._startThread(event_thread)
 
 
 class EventThread(threading.Thread):
@@ -136,19 +472,39 @@ class EventThread(threading.Thread):
     """
     __metaclass__ = ABCMeta
     log = logging.getLogger("events.EventThread")
+    # whether the handler waits for this event to cleanup its flow
+    gated = False
+
+    def __init__(self, event, handler):
+        """
+        @param event: the parsed Event
+        @param handler: the EventsHandler dispatching the event
+        """
+        super(EventThread, self).__init__(name=event.name)
+        self.daemon = True
+        self.event = event
+        self.data = event.data
+        self.name = event.name
+        self.build = event.build
+        self.received = event.received
+        self.handler = handler
+        self.jenkinsmgr = handler.jenkinsmgr
+        self.flows = handler.flows
+        self.lock = handler.lock
+        self.discoverer = handler.discoverer
+        self.publisher = handler.publisher
+        self.stats = handler.stats
+        self.watermarks = handler.watermarks
 
-    def __init__(self, data, jenkinsmgr, flows, lock):
-        self.data = json.loads(data)
-        super(EventThread, self).__init__(name=self.data["name"])
-        self.name = self.data["name"]
-        self.build = self.data["build"]
-        self.jenkinsmgr = jenkinsmgr
-        self.flows = flows
-        self.lock = lock
-
-    @abstractmethod
     def run(self):
-        pass
+        self.log.info("Start to Update Flow/Job <%s> Status" % self.name)
+        try:
+            self.updateStatus()
+        finally:
+            if self.gated:
+                self.handler.gates.open(self.name)
+            else:
+                self.handler.releaseSlot()
 
     def getCauses(self):
         """
@@ -162,10 +518,15 @@ class EventThread(threading.Thread):
     def getDuration(self):
         """
         get duration
-        return seconds
+        return seconds, None if jenkins is unavailable
         """
-        duration = self.jenkinsmgr.getDuration(self.name,
-                                               self.build["number"])
+        try:
+            duration = self.jenkinsmgr.getDuration(self.name,
+                                                   self.build["number"])
+        except Exception as excp:
+            self.log.warning("Unable to get the duration of <%s/%s>: %s"
+                             % (self.name, self.build["number"], excp))
+            return None
         return duration.total_seconds()
 
     @property
@@ -214,79 +575,116 @@ class EventThread(threading.Thread):
 
     def checkEventOutdated(self):
         """
-        check whether the job event is outdated
-        only need to check for job/subflow event
+        check whether the event belongs to an out-dated build of its
+        root flow, against the build watermarks kept in memory
         @return: True for outdated, otherwise False
         """
         self.log.debug("check whether Event <%s> is out-dated." % self.name)
-        outdated_msg = "The Event <%s> is out-dated. Ignore it." % self.name
 
-        if self.isrootflow:
-            flow = self.flows.get(self.name, None)
-            if not flow:
-                # return True for None
-                self.log.debug(" ".join(["Unable to find Flow",
-                                         "<%s> in" % self.name,
-                                         "configuration file"]))
-                return True
+        if self.causes:
+            upstream_flow = self.causes[0]
+            flow_name = upstream_flow.upstreamProject
+            flow_buildno = int(upstream_flow.upstreamBuild)
+        else:
+            flow_name = self.name
+            flow_buildno = int(self.build["number"])
 
-            new_buildno = int(self.build["number"])
-            try:
-                # to avoid missing attribute or number info
-                current_buildno = int(flow.build["number"])
-            except:
-                return False
-
-            if new_buildno < current_buildno:
-                self.log.debug(outdated_msg)
-                return True
+        current_buildno = self.watermarks.getFlowBuild(flow_name)
+        if current_buildno is None:
             return False
-        else:
-            upstream_flow = self.causes[0]
-            upstream_flowname = upstream_flow.upstreamProject
-            upstream_flowno = upstream_flow.upstreamBuild
-            self.log.info("upstream %s: %s" % (upstream_flowname,
-                                               upstream_flowno))
-            try:
-                current_flow = self.flows.get(upstream_flowname)
-                current_flowno = current_flow.build["number"]
-                self.log.info("current %s: %s" % (upstream_flowname,
-                                                  current_flowno))
-            except:
-                self.log.error("Missing Flow <%s> Info." % upstream_flowname)
-                return False
-            if upstream_flowno < current_flowno:
-                self.log.debug(outdated_msg)
-                return True
-            else:
-                return False
+
+        if flow_buildno < current_buildno:
+            self.log.debug(" ".join(["The Event <%s> of" % self.name,
+                                     "Flow <%s/%s>" % (flow_name,
+                                                       flow_buildno),
+                                     "is out-dated by",
+                                     "build %s." % current_buildno,
+                                     "Ignore it."]))
+            return True
+        return False
 
     def updateStatus(self):
         """
         update Event status
         """
-        if self.causes:
+        try:
+            causes = self.causes
+            isflow = True if causes else self.isflow
+        except Exception as excp:
+            self.log.warning(" ".join(["Unable to query Jenkins: %s." % excp,
+                                       "Update <%s> in" % self.name,
+                                       "degraded mode."]))
+            self._updateDegraded()
+            return
+
+        if causes:
             # subflows or jobs
             self._updateJobStatus()
         else:
             # no causes jobs
-            if not self.isflow:
+            if not isflow:
                 self.log.debug("Job <%s> has no upstream flow." % self.name)
                 return
 
             # uppermost flow
             self._updateFlowStatus()
 
+    def _updateDegraded(self):
+        """
+        update the status only with the information in the event,
+        the durations are enriched when jenkins recovers
+        """
+        if self.name in self.flows:
+            # the root flows have no causes
+            self._causes = None
+            self._updateFlowStatus()
+            return
+
+        # without the causes, the job is only updated if a single running
+        # flow contains it, until its flow is resolved from its causes
+        self.handler.hold(self.event)
+        running = [(flow_name, flow.index.get(self.name))
+                   for (flow_name, flow) in self.flows.items()
+                   if flow.index.get(self.name) and
+                   flow.summary.status == "running"]
+        if len(running) != 1:
+            self.log.debug("Job <%s> is in %d running flows. Hold it."
+                           % (self.name, len(running)))
+            return
+        (flow_name, event_jobs) = running[0]
+        self._waitCleanup(flow_name)
+        self._updateJobs(flow_name, event_jobs, check=False,
+                         provisional=True)
+
     def _updateJobStatus(self):
         """
         update job status
         """
         upstream_flow = self.causes[0]
         upstreamProject = upstream_flow.upstreamProject
+        self._waitCleanup(upstreamProject)
+
+        if self.discoverer:
+            self.discoverer.observeJob(upstreamProject,
+                                       upstream_flow.upstreamBuild,
+                                       self.name,
+                                       self.build,
+                                       self.status,
+                                       self.received,
+                                       self.event.started)
 
         try:
-            jobs = self.flows[upstreamProject].jobs
+            event_jobs = self.flows[upstreamProject].index.get(self.name)
         except KeyError:
+            if upstreamProject in self.handler.external:
+                self.log.debug("Flow <%s> is handled by another worker."
+                               % upstreamProject)
+                return
+            if self.discoverer and \
+                    self.discoverer.isDiscoverable(upstreamProject):
+                self.log.debug("Flow <%s> is being discovered."
+                               % upstreamProject)
+                return
             self.log.error(" ".join(["Unable to find Job",
                                      "<%s>'s upstream" % self.name,
                                      "Project <%s>" % upstreamProject,
@@ -299,14 +697,24 @@ class EventThread(threading.Thread):
                                      "configuration file."]))
             return
 
-        event_jobs = self._findJobs(jobs)
         if not event_jobs:
             return
 
+        self._updateJobs(upstreamProject, event_jobs)
+
+    def _updateJobs(self, flow_name, event_jobs, check=True,
+                    provisional=False):
+        """
+        update the job instance matching the event in a root flow
+        @param check: whether to check the event is outdated
+        @param provisional: whether the flow of the job is guessed, the
+                            duration is then left to the resolved event
+        """
+        duration = None if provisional else self.getDuration()
         with self.lock:
             self.log.debug("Job <%s> acquires the lock" % self.name)
             # check outdated
-            if self.checkEventOutdated():
+            if check and self.checkEventOutdated():
                 return
 
             # update status
@@ -314,9 +722,21 @@ class EventThread(threading.Thread):
             for event_job in event_jobs:
                 identifiers = event_job.identifier
                 if self._isMatched(identifiers, parameters):
-                    event_job.build = self.build
-                    event_job.status = self.status
-                    event_job.duration = self.getDuration()
+                    event_job.update(self.build,
+                                     self.status,
+                                     duration,
+                                     self.received)
+                    finished = self.status != "running" and \
+                        not provisional
+                    if finished and duration is None:
+                        self.handler.enrich(flow_name, event_job, self.name,
+                                            self.build["number"])
+                    elif finished and self.stats:
+                        self.stats.observe(flow_name, event_job, duration)
+                    if self.stats:
+                        self.stats.planFlow(flow_name, self.flows[flow_name])
+                    if self.publisher:
+                        self.publisher.publishJob(flow_name, event_job)
 
                     self.log.debug(" ".join(["Successfully Update Job",
                                              "<%s> status" % self.name
@@ -331,8 +751,17 @@ class EventThread(threading.Thread):
         """
         update flow status
         """
+        if not self.gated:
+            self._waitCleanup(self.name)
+
+        duration = self.getDuration()
         with self.lock:
             self.log.debug("Flow <%s> acquires the lock" % self.name)
+            if self.discoverer:
+                self.discoverer.observeFlow(self.name,
+                                            self.build,
+                                            self.status,
+                                            self.received)
             flow = self.flows.get(self.name, None)
             if flow:
                 if self.checkEventOutdated():
@@ -340,7 +769,19 @@ class EventThread(threading.Thread):
                 self._cleanupFlowStatus()
                 flow.build = self.build
                 flow.status = self.status
-                flow.duration = self.getDuration()
+                flow.duration = duration
+                if duration is None and self.status != "running":
+                    self.handler.enrich(self.name, flow, self.name,
+                                        self.build["number"])
+                flow.summary.flowChanged(self.build,
+                                         self.status,
+                                         self.received)
+                if self.stats:
+                    self.stats.planFlow(self.name, flow)
+                if self.publisher:
+                    # a started flow has cleaned up all its jobs
+                    self.publisher.publishFlow(self.name, flow,
+                                               reset=self.status == "running")
                 self.log.debug(" ".join(["Successfully Update Flow",
                                          "<%s> status" % self.name
                                          ]))
@@ -356,26 +797,13 @@ class EventThread(threading.Thread):
         """
         pass
 
-    def _findJobs(self, jobs):
+    def _waitCleanup(self, flow_name):
         """
-        find jobs that matches job_name
-        @param jobs: the jobs config
-        @return: jobs list
+        wait for the pending cleanup of the root flow
         """
-        jobs_list = list()
-
-        if not hasattr(jobs, "__iter__"):
-            if jobs.name == self.name:
-                jobs_list.append(jobs)
-                return jobs_list
-            return None
-
-        for job in jobs:
-            job_list = self._findJobs(job)
-            if job_list:
-                jobs_list.extend(job_list)
-
-        return jobs_list if jobs_list else None
+        if not self.handler.gates.wait(flow_name, GATE_TIMEOUT):
+            self.log.warning("Timed out waiting for the cleanup of Flow <%s>"
+                             % flow_name)
 
     def _isMatched(self, identifiers, parameters):
         """
@@ -403,7 +831,7 @@ class StartedEventThread(EventThread):
     def _cleanupFlowStatus(self):
         flow = self.flows.get(self.name, None)
         try:
-            jobs = flow.jobs
+            instances = flow.instances
         except AttributeError:
             self.log.error(" ".join(["Flow <%s> has" % self.name,
                                      "no jobs in the",
@@ -412,37 +840,11 @@ class StartedEventThread(EventThread):
         flow.build = None
         flow.status = None
         flow.duration = 0
-        jobs_list = self._getJobsList(jobs)
-        for job in jobs_list:
-            job.build = None
-            job.status = None
-            job.duration = 0
+        for job in instances:
+            job.reset()
         self.log.debug("Successfully cleanup all the downstream jobs.")
         return
 
-    def _getJobsList(self, jobs):
-        """
-        get jobs list from jobs config
-        @param jobs: the jobs config
-        @return: jobs list
-        """
-        jobs_list = list()
-
-        if not hasattr(jobs, "__iter__"):
-            jobs_list.append(jobs)
-            return jobs_list
-
-        for job in jobs:
-            job_list = self._getJobsList(job)
-            if job_list:
-                jobs_list.extend(job_list)
-
-        return jobs_list if jobs_list else None
-
-    def run(self):
-        self.log.info("Start to Update Flow/Job <%s> Status" % self.name)
-        self.updateStatus()
-
 
 class FinalizedEventThread(EventThread):
     log = logging.getLogger("events.FinalizedEventThread")
@@ -451,9 +853,6 @@ class FinalizedEventThread(EventThread):
         status = STATUS_MAP[self.build["status"]]
         return status
 
-    def run(self):
-        self.log.info("Start to Update Flow/Job <%s> Status" % self.name)
-        self.updateStatus()
 
 if __name__ == "__main__":
     from reflatus.utils import setup_logging
@@ -0,0 +1,319 @@
+"""
+journal the events with the jenkins responses, and replay them offline
+"""
+import os
+import json
+import time
+import datetime
+import threading
+import logging
+import collections
+from reflatus.loader import Loader
+from reflatus.events import EventsHandler
+from reflatus.myjenkins import UpstreamInfo
+from reflatus.utils import JenkinsUnavailableException
+
+
+# the size in bytes to rotate the journal
+MAX_BYTES = 64 * 1024 * 1024
+# the number of the rotated journals kept, journal.1 being the newest
+BACKUPS = 5
+# the seconds between flushing the journal to disk
+FLUSH_INTERVAL = 1
+
+
+class Journal(object):
+    """
+    an append-only journal in json lines, rotated by size
+
+    Each line is either a received zmq event:
+        {"t": <received>, "event": <raw event>}
+    or a jenkins response used to process the events:
+        {"t": <timestamp>, "call": <method>, "args": [...],
+         "source": [<topic>, <name>, <build number>] or null,
+         "result": <response>} or "error" instead of "result"
+    where source is the event whose handling made the call
+    """
+    log = logging.getLogger('journal.Journal')
+
+    def __init__(self, path, max_bytes=MAX_BYTES, backups=BACKUPS):
+        """
+        @param path: the journal file path
+        @param max_bytes: the size in bytes to rotate the journal
+        @param backups: the number of the rotated journals kept
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        # the types of the jobs, journaled when they change and at the
+        # top of each journal file, so that each file is self-contained
+        self._types = dict()
+        self._flushed = 0
+        self._open()
+        self.log.info("Journal the events into %s" % path)
+
+    def _open(self):
+        self._file = open(self.path, 'a')
+        self._size = os.path.getsize(self.path)
+
+    def recordEvent(self, event, received):
+        """
+        @param event: the raw zmq event
+        @param received: the timestamp receiving the event
+        """
+        self._write(dict(t=received, event=event))
+
+    def recordType(self, flow_name, isflow):
+        """
+        @param isflow: whether the job is a flow
+        """
+        with self.lock:
+            if self._types.get(flow_name, None) == isflow:
+                return
+            self._types[flow_name] = isflow
+        self._write(self._typeEntry(flow_name, isflow))
+
+    @staticmethod
+    def _typeEntry(flow_name, isflow):
+        return dict(t=time.time(), call="is_flow", args=[flow_name],
+                    source=None, result=isflow)
+
+    def recordCall(self, call, args, result=None, error=None, source=None):
+        """
+        @param call: the JenkinsManager method
+        @param result: the json serializable response
+        @param error: the error message if the call failed
+        @param source: the key of the event making the call, see getSource
+        """
+        entry = dict(t=time.time(), call=call, args=list(args),
+                     source=source)
+        if error is None:
+            entry["result"] = result
+        else:
+            entry["error"] = error
+        self._write(entry)
+
+    def _write(self, entry):
+        with self.lock:
+            if self._file is None:
+                return
+            self._writeLine(entry)
+            now = time.time()
+            if now - self._flushed >= FLUSH_INTERVAL:
+                self._file.flush()
+                self._flushed = now
+            if self._size >= self.max_bytes:
+                self._rotate()
+
+    def _writeLine(self, entry):
+        line = "%s\n" % json.dumps(entry, separators=(',', ':'))
+        self._file.write(line)
+        self._size += len(line)
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backups - 1, 0, -1):
+            backup = "%s.%d" % (self.path, index)
+            if os.path.exists(backup):
+                os.rename(backup, "%s.%d" % (self.path, index + 1))
+        if self.backups > 0:
+            os.rename(self.path, "%s.1" % self.path)
+        else:
+            os.remove(self.path)
+        self._open()
+        for (flow_name, isflow) in sorted(self._types.iteritems()):
+            self._writeLine(self._typeEntry(flow_name, isflow))
+
+    def close(self):
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def readJournal(path):
+    """
+    read the entries of a journal, from its oldest rotated backup
+    """
+    paths = list()
+    index = 1
+    while os.path.exists("%s.%d" % (path, index)):
+        paths.insert(0, "%s.%d" % (path, index))
+        index += 1
+    if os.path.exists(path):
+        paths.append(path)
+
+    for journal_path in paths:
+        with open(journal_path) as journal_file:
+            for line in journal_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def getSource():
+    """
+    get the event handled by the current thread, which makes the jenkins
+    calls, to match the calls of the same event on replay
+    @return: (topic, name, build number), None out of an event thread
+    """
+    event = getattr(threading.current_thread(), "event", None)
+    if event is None:
+        return None
+    return (event.topic, event.name, event.build["number"])
+
+
+class JournaledJenkins(object):
+    """
+    a wrapped JenkinsManager recording its responses into a journal
+    """
+    def __init__(self, jenkinsmgr, journal):
+        """
+        @param jenkinsmgr: JenkinsManager instance
+        @param journal: Journal instance
+        """
+        self.jenkinsmgr = jenkinsmgr
+        self.journal = journal
+
+    def __getattr__(self, attr):
+        return getattr(self.jenkinsmgr, attr)
+
+    def _call(self, call, args, encode):
+        try:
+            result = getattr(self.jenkinsmgr, call)(*args)
+        except Exception as excp:
+            self.journal.recordCall(call, args, error=str(excp),
+                                    source=getSource())
+            raise
+        return (result, encode(result))
+
+    def is_flow(self, flow_name):
+        (isflow, _) = self._call("is_flow", (flow_name,), bool)
+        self.journal.recordType(flow_name, isflow)
+        return isflow
+
+    def getRootCauses(self, job_name, build_number):
+        args = (job_name, build_number)
+        (causes, result) = self._call("getRootCauses", args,
+                                      lambda causes: [cause.__dict__
+                                                      for cause in causes]
+                                      if causes else None)
+        self.journal.recordCall("getRootCauses", args, result,
+                                source=getSource())
+        return causes
+
+    def getDuration(self, job_name, build_number):
+        args = (job_name, build_number)
+        (duration, result) = self._call("getDuration", args,
+                                        lambda duration:
+                                        duration.total_seconds())
+        self.journal.recordCall("getDuration", args, result,
+                                source=getSource())
+        return duration
+
+
+class ReplayJenkins(object):
+    """
+    a stub JenkinsManager answering with the journaled responses
+
+    The responses are matched by the event making the call, so that
+    the events handled concurrently get their own responses whatever
+    the thread scheduling. The responses of the same call for the same
+    event are answered in the journaled order, and the last one is
+    repeated once they are exhausted. The types of the jobs, journaled
+    only when they change, are answered with the latest one.
+    """
+    available = True
+
+    def __init__(self):
+        self.responses = dict()
+        self.types = dict()
+
+    def record(self, entry):
+        if entry["call"] == "is_flow":
+            if "result" in entry:
+                self.types[entry["args"][0]] = entry["result"]
+            return
+        source = entry.get("source", None)
+        key = (tuple(source) if source else None,
+               entry["call"],
+               tuple(entry["args"]))
+        self.responses.setdefault(key, collections.deque()).append(entry)
+
+    def _answer(self, call, *args):
+        responses = self.responses.get((getSource(), call, args), None)
+        if not responses:
+            # e.g. the enrichment out of the event threads
+            responses = self.responses.get((None, call, args), None)
+        if not responses:
+            raise JenkinsUnavailableException("No journaled response of "
+                                              "%s%r" % (call, args))
+        entry = responses.popleft() if len(responses) > 1 else responses[0]
+        if "error" in entry:
+            raise JenkinsUnavailableException(entry["error"])
+        return entry["result"]
+
+    def is_flow(self, flow_name):
+        if flow_name not in self.types:
+            raise JenkinsUnavailableException("No journaled type of %s"
+                                              % flow_name)
+        return self.types[flow_name]
+
+    def getRootCauses(self, job_name, build_number):
+        causes = self._answer("getRootCauses", job_name, build_number)
+        if not causes:
+            return None
+        return [UpstreamInfo(cause) for cause in causes]
+
+    def getDuration(self, job_name, build_number):
+        seconds = self._answer("getDuration", job_name, build_number)
+        return datetime.timedelta(seconds=seconds)
+
+
+def replay(journal_path, flows_path, speed=1.0):
+    """
+    feed a journal through an EventsHandler against the journaled
+    jenkins responses
+    @param speed: the acceleration factor, 0 for as fast as possible
+    @return: the flows after the replay
+    """
+    log = logging.getLogger('journal.replay')
+    jenkinsmgr = ReplayJenkins()
+    events = list()
+    for entry in readJournal(journal_path):
+        if "event" in entry:
+            events.append(entry)
+        else:
+            jenkinsmgr.record(entry)
+    log.info("Replay %d events from %s" % (len(events), journal_path))
+
+    (flows, _) = Loader(flows_path).getConfig()
+    handler = EventsHandler("replay", jenkinsmgr, flows)
+    handler.start()
+    started = time.time()
+    for entry in events:
+        if speed and entry is not events[0]:
+            delay = (entry["t"] - events[0]["t"]) / speed - \
+                (time.time() - started)
+            if delay > 0:
+                time.sleep(delay)
+        handler.submitEvent(entry["event"], entry["t"])
+    handler.stop()
+    handler.join()
+
+    elapsed = time.time() - started
+    log.info("Replayed %d events in %.2fs (%.0f events/s)"
+             % (len(events), elapsed, len(events) / max(elapsed, 1e-6)))
+    return flows
+
+
+if __name__ == "__main__":
+    import sys
+    from reflatus.utils import setup_logging
+    setup_logging()
+    journal_path = sys.argv[1] if len(sys.argv) > 1 else './journal.log'
+    flows_path = sys.argv[2] if len(sys.argv) > 2 else './conf/flows.yaml'
+    speed = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+    flows = replay(journal_path, flows_path, speed)
+    for (flow_name, flow) in sorted(flows.items()):
+        print flow_name, flow.summary.asdict()
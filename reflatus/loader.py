@@ -1,9 +1,25 @@
 """
 load/parse flow yaml file
 """
+import os
+import time
+import hashlib
 import yaml
 import logging
-from reflatus.utils import ConfigInfo
+from six.moves import cPickle as pickle
+from reflatus.utils import ConfigInfo, CircularLabelException
+from reflatus.state import JobInstance, FlowSummary
+
+try:
+    # use the libyaml based loader if available, which is much faster
+    from yaml import CSafeLoader as YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader
+
+
+# bump this whenever the structure of the reshaped flows changes,
+# so that stale caches are discarded
+CACHE_VERSION = 7
 
 class Serial(list):
     """
@@ -21,6 +37,18 @@ class Parallel(list):
         return 'parallel(%s)' % super(Parallel, self).__str__()
 
 
+class Labeled(Serial):
+    """
+    used to mark up the expanded jobs of a labeled flow
+    """
+    def __init__(self, label, jobs=()):
+        super(Labeled, self).__init__(jobs)
+        self.label = label
+
+    def __str__(self):
+        return 'Labeled(%s, %s)' % (self.label, list.__str__(self))
+
+
 class FlowConfig(ConfigInfo):
     def __repr__(self):
         return "<Flow {0.name}>".format(self)
@@ -37,28 +65,107 @@ class Loader(object):
     """
     log = logging.getLogger('loader.Loader')
 
-    def __init__(self, path):
+    def __init__(self, path, cache_path=None):
         """
         @param path: the path of the yaml file
+        @param cache_path: the path of the compiled cache file,
+                           None to disable caching
         """
         self.path = path
+        self.cache_path = cache_path
         self.original_data = None
 
     def getConfig(self):
         self.read()
         return self.conf.reshaped_flows, self.conf.flows_map
 
+    def getConfigFromData(self, data):
+        """
+        build the flows from the already parsed data, in the same format
+        as the yaml file, without reading the file nor the cache
+        """
+        self._parse(data)
+        self.reshape()
+        self.getMap()
+        return self.conf.reshaped_flows, self.conf.flows_map
+
     def read(self):
         self.log.info("Read flows' configuration file: %s" % self.path)
-        self._read()
+        with open(self.path, 'rb') as conf_file:
+            content = conf_file.read()
+        digest = hashlib.sha1(content).hexdigest()
+
+        if self._loadCache(digest):
+            return
+
+        self._read(content)
         self.reshape()
         self.getMap()
+        self._dumpCache(digest)
 
-    def _read(self):
+    def _loadCache(self, digest):
+        """
+        load the reshaped flows and flow maps from the compiled cache
+        @param digest: the content hash of the yaml file
+        @return: True if the cache is valid and loaded, otherwise False
+        """
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return False
+
+        try:
+            with open(self.cache_path, 'rb') as cache_file:
+                (version, cache_digest,
+                 reshaped_flows, flows_map) = pickle.load(cache_file)
+        except Exception as excp:
+            self.log.warning("Unable to load cache %s: %s" % (self.cache_path,
+                                                              excp))
+            return False
+
+        if version != CACHE_VERSION or cache_digest != digest:
+            self.log.info("Cache %s is out-dated. Ignore it."
+                          % self.cache_path)
+            return False
+
+        self.log.info("Load flows from cache %s" % self.cache_path)
+        self.conf = ConfigInfo()
+        self.conf.reshaped_flows = reshaped_flows
+        self.conf.flows_map = flows_map
+        return True
+
+    def _dumpCache(self, digest):
+        """
+        dump the reshaped flows and flow maps into the compiled cache
+        @param digest: the content hash of the yaml file
+        """
+        if not self.cache_path:
+            return
+
+        data = (CACHE_VERSION, digest,
+                self.conf.reshaped_flows, self.conf.flows_map)
+        tmp_path = "%s.%d.tmp" % (self.cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as cache_file:
+                pickle.dump(data, cache_file, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.cache_path)
+            self.log.debug("Dump flows into cache %s" % self.cache_path)
+        except Exception as excp:
+            self.log.warning("Unable to dump cache %s: %s" % (self.cache_path,
+                                                              excp))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _read(self, content):
         """
         read the native conf file into a well-constructed format
+        @param content: the content of the yaml file
         """
-        self.original_data = yaml.load(open(self.path))
+        self._parse(yaml.load(content, Loader=YAMLLoader))
+
+    def _parse(self, data):
+        """
+        @param data: the parsed content of the yaml file
+        """
+        self.original_data = data
         self.conf = ConfigInfo()
         self.conf.flows = {}
         flows = self.original_data.get('flows', None)
@@ -120,56 +227,113 @@ class Loader(object):
         self.log.debug("Reshape flows' structure")
         flows = self.conf.flows
         reshaped_flows = dict()
+        # memoized expansions of labeled flows, shared by all the flows
+        self._expanded = dict()
         for (flow_name, flow_info) in flows.iteritems():
             if flow_info.getattr('label'):
                 continue
+            jobs = self._reshape(flow_name)
+            if jobs is None:
+                continue
             f = FlowConfig()
             f.name = flow_name
-            f.jobs = self._reshape(flow_name)
+            f.jobs = self._instantiate(jobs)
+            f.instances = self._getInstances(f.jobs)
+            f.summary = FlowSummary(len(f.instances))
+            f.index = dict()
+            for (index, instance) in enumerate(f.instances):
+                instance.index = index
+                instance.summary = f.summary
+                f.index.setdefault(instance.name, list()).append(instance)
             reshaped_flows[f.name] = f
         self.conf.reshaped_flows = reshaped_flows
 
     def _reshape(self, flow_name):
         """
-        TBD: only support flows with single serial or parallel label
+        expand all the (nested) labeled flows of a flow
+        @return: the reshaped jobs, None for failure
         """
         try:
-            jobs = self.conf.flows[flow_name].jobs
-            reshaped_jobs = Serial()
-            for job in jobs:
-
-                job_serial = self.is_serial(job)
-                if job_serial:
-                    job_list = Serial()
-                else:
-                    job_list = Parallel()
-
-                for subjob in job:
-                    if subjob.getattr('label'):
-                        labeled_jobs = self.conf.flows[subjob.name].jobs
-                        if len(labeled_jobs) == 1:
-                            labeled_job = labeled_jobs[0]
-                            labeled_job_serial = self.is_serial(labeled_job)
-
-                            if job_serial == labeled_job_serial:
-                                job_list.extend(labeled_job)
-                            else:
-                                job_list.append(labeled_job)
-
-                        else:
-                            self.log.error(" ".join(["Unsupported Structure.",
-                                                     "Will support later."]))
-                            return None
-                    else:
-                        job_list.append(subjob)
-
-                reshaped_jobs.append(job_list)
-            return reshaped_jobs
+            return self._expand(flow_name, [flow_name])
         except Exception as excp:
             self.log.error("Unable to reshape flow %s" % flow_name)
             self.log.error(excp)
             return None
 
+    def _expand(self, flow_name, expanding):
+        """
+        substitute the labeled jobs of a flow with their expansions
+        @param flow_name: the name of the flow to expand
+        @param expanding: the labels being expanded, used to detect cycles
+        """
+        jobs = self.conf.flows[flow_name].jobs
+        expanded_jobs = Serial()
+        for job in jobs:
+            if self.is_serial(job):
+                job_list = Serial()
+            else:
+                job_list = Parallel()
+
+            for subjob in job:
+                if subjob.getattr('label'):
+                    job_list.append(self._expandLabel(subjob.name,
+                                                      expanding))
+                else:
+                    job_list.append(subjob)
+
+            expanded_jobs.append(job_list)
+        return expanded_jobs
+
+    def _expandLabel(self, label, expanding):
+        """
+        expand a labeled flow only once, whichever flows reference it
+        """
+        labeled_jobs = self._expanded.get(label, None)
+        if labeled_jobs is not None:
+            return labeled_jobs
+
+        if label in expanding:
+            raise CircularLabelException(" -> ".join(expanding + [label]))
+
+        if label not in self.conf.flows:
+            raise KeyError("Unable to find labeled flow <%s>" % label)
+
+        expanding.append(label)
+        labeled_jobs = Labeled(label, self._expand(label, expanding))
+        expanding.pop()
+        self._expanded[label] = labeled_jobs
+        return labeled_jobs
+
+    def _instantiate(self, jobs):
+        """
+        create the job instances of a flow from the shared job definitions
+        """
+        if isinstance(jobs, JobConfig):
+            return JobInstance(jobs)
+
+        if isinstance(jobs, Labeled):
+            instances = Labeled(jobs.label)
+        elif self.is_serial(jobs):
+            instances = Serial()
+        else:
+            instances = Parallel()
+
+        for job in jobs:
+            instances.append(self._instantiate(job))
+        return instances
+
+    def _getInstances(self, jobs):
+        """
+        flatten the job instances of a flow
+        """
+        if isinstance(jobs, JobInstance):
+            return [jobs]
+
+        instances = list()
+        for job in jobs:
+            instances.extend(self._getInstances(job))
+        return instances
+
     def getMap(self):
         """
         Generate flow map used for plotting in the front-end
@@ -179,7 +343,11 @@ class Loader(object):
         flow_map = dict()
         for (flow_name, flow_info) in flows.iteritems():
             self.log.debug("Generate flow map for Flow <%s>" % flow_name)
-            flow_map[flow_name] = self.generateMap(flow_info.jobs)
+            job_map = flow_map[flow_name] = self.generateMap(flow_info.jobs)
+            # the indexes of the previous instances of each instance
+            flow_info.previous = [[job_map[job_id].index
+                                   for job_id in job.previous or list()]
+                                  for job in flow_info.instances]
         self.conf.flows_map = flow_map
 
     def generateMap(self, jobs):
@@ -197,7 +365,7 @@ class Loader(object):
             previous_list = list()
 
         for job in jobs:
-            if not isinstance(job, JobConfig):
+            if not isinstance(job, JobInstance):
                 (job_map, subprevious) = self._generateMap(job,
                                                            previous)
                 jobs_map.update(job_map)
@@ -241,10 +409,36 @@ class Loader(object):
         return False
 
 
+def benchmark(filepath, cache_path, rounds=5):
+    """
+    compare cold (parse and reshape) and warm (cached) load time
+    """
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+
+    start = time.time()
+    Loader(filepath, cache_path).getConfig()
+    cold = time.time() - start
+
+    warm = list()
+    for _ in range(rounds):
+        start = time.time()
+        Loader(filepath, cache_path).getConfig()
+        warm.append(time.time() - start)
+
+    print "cold load: %.4fs" % cold
+    print "warm load: %.4fs (best of %d)" % (min(warm), rounds)
+
+
 if __name__ == "__main__":
+    import sys
     from reflatus.utils import setup_logging
     setup_logging()
-    filepath = './conf/flows.yaml'
-    c = Loader(filepath)
-    d = c.getConfig()
-    print d
+    filepath = sys.argv[1] if len(sys.argv) > 1 else './conf/flows.yaml'
+    if len(sys.argv) > 2 and sys.argv[2] == "--benchmark":
+        logging.getLogger().setLevel(logging.WARNING)
+        benchmark(filepath, "%s.bench.cache" % filepath)
+    else:
+        c = Loader(filepath)
+        d = c.getConfig()
+        print d
@@ -3,15 +3,98 @@ Jenkins utils
 """
 from jenkinsapi.jenkins import Jenkins
 import logging
+import threading
+import time
 import xmltodict
+from requests import exceptions as requests_exceptions
 from requests.packages import urllib3
-from reflatus.utils import ConfigInfo
+from reflatus.utils import ConfigInfo, JenkinsUnavailableException
 
 
 # disable warnings of urllib3 used by jenkinsapi
 urllib3.disable_warnings()
 logging.getLogger("requests").setLevel(logging.WARNING)
 
+# the seconds to wait for a response from Jenkins
+DEFAULT_TIMEOUT = 10
+# the number of consecutive failures to stop calling Jenkins
+BREAKER_THRESHOLD = 5
+# the seconds to wait before calling Jenkins again
+BREAKER_COOLDOWN = 30
+# the seconds to cache the type (job or flow) of a job
+TYPE_CACHE_TTL = 600
+
+
+class CircuitBreaker(object):
+    """
+    stop calling Jenkins after consecutive failures, so that the events
+    fail fast instead of piling up, and let a trial call through after
+    the cool down to detect the recovery
+    """
+    log = logging.getLogger('myjenkins.CircuitBreaker')
+
+    def __init__(self, threshold=BREAKER_THRESHOLD,
+                 cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    @property
+    def available(self):
+        """
+        whether Jenkins may be called
+        """
+        if self.opened is None:
+            return True
+        return time.time() - self.opened >= self.cooldown
+
+    @staticmethod
+    def isOutage(excp):
+        """
+        whether an error means Jenkins is unavailable: a timeout,
+        a connection error or a server error. The others, e.g. an unknown
+        job or a permission denied, are answers of an available Jenkins
+        """
+        if isinstance(excp, (requests_exceptions.Timeout,
+                             requests_exceptions.ConnectionError)):
+            return True
+        if isinstance(excp, requests_exceptions.HTTPError):
+            response = excp.response
+            return response is None or response.status_code >= 500
+        return False
+
+    def call(self, func, *args):
+        if not self.available:
+            raise JenkinsUnavailableException("Jenkins is unavailable")
+
+        try:
+            result = func(*args)
+        except Exception as excp:
+            if not self.isOutage(excp):
+                self._succeeded()
+                raise
+            with self.lock:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    if self.opened is None:
+                        self.log.error("Jenkins is unavailable after %d "
+                                       "failures." % self.failures)
+                    # (re)start the cool down
+                    self.opened = time.time()
+            raise
+
+        self._succeeded()
+        return result
+
+    def _succeeded(self):
+        with self.lock:
+            if self.opened is not None:
+                self.log.info("Jenkins is available again.")
+            self.failures = 0
+            self.opened = None
+
 
 class JenkinsManager(object):
     """
@@ -19,18 +102,23 @@ class JenkinsManager(object):
     """
     log = logging.getLogger('myjenkins.JenkinsManager')
 
-    def __init__(self, baseurl, username, password):
+    def __init__(self, baseurl, username, password, timeout=DEFAULT_TIMEOUT):
         """
         @param baseurl: the url of jenkins
         @param username: jenkins username
         @param password: jenkins password
+        @param timeout: the seconds to wait for a response from jenkins
         """
         self.baseurl = baseurl
         self.username = username
         self.password = password
+        self.timeout = timeout
+        self.breaker = CircuitBreaker()
+        self._types = dict()
         self.server = Jenkins(baseurl=self.baseurl,
                               username=self.username,
-                              password=self.password)
+                              password=self.password,
+                              timeout=timeout)
         self.log.info("Access Jenkins %s with username: %s" % (self.baseurl,
                                                                self.username))
 
@@ -43,21 +131,41 @@ class JenkinsManager(object):
     def is_flow(self, flow_name):
         """
         identify the flow type
+        cached for TYPE_CACHE_TTL, since it rarely changes
         """
-        return True if self.getConfig(flow_name) \
-                           .get('com.cloudbees.plugins.flow.BuildFlow') \
+        (isflow, expires) = self._types.get(flow_name, (None, 0))
+        if time.time() < expires:
+            return isflow
+
+        isflow = True if self.getConfig(flow_name) \
+                             .get('com.cloudbees.plugins.flow.BuildFlow') \
             else False
+        self._types[flow_name] = (isflow, time.time() + TYPE_CACHE_TTL)
+        return isflow
+
+    @property
+    def available(self):
+        """
+        whether jenkins is considered available
+        """
+        return self.breaker.available
 
     def getConfig(self, job_name):
         """
         get the config of the job
         jobname/config.xml
         """
+        return self.breaker.call(self._getConfig, job_name)
+
+    def _getConfig(self, job_name):
         job = self.server.get_job(job_name)
         job_config = xmltodict.parse(job.get_config())
         return job_config
 
     def getBuild(self, job_name, build_number):
+        return self.breaker.call(self._getBuild, job_name, build_number)
+
+    def _getBuild(self, job_name, build_number):
         return self.server.get_job(job_name).get_build(build_number)
 
     def getDuration(self, job_name, build_number):
@@ -0,0 +1,79 @@
+"""
+This publisher.py focuses on republishing the flow state changes
+"""
+import zmq
+import json
+import threading
+import logging
+
+
+class FlowStatePublisher(object):
+    """
+    publish the normalized flow state changes on a zmq PUB socket
+
+    The messages are formatted as "<topic> <json data>", the same as the
+    events from Jenkins, with the topics:
+        onFlowState: {"flow", "status", "build", "url", "duration", "reset"}
+        onJobState: {"flow", "node", "job", "status", "build", "url",
+                     "duration"}
+    where "node" is the index of the job in the flow.
+    """
+    log = logging.getLogger('publisher.FlowStatePublisher')
+
+    def __init__(self, addr):
+        """
+        @param addr: the address to bind, e.g. tcp://*:8889
+        """
+        self.addr = addr
+        self._context = zmq.Context()
+        self.socket = self._context.socket(zmq.PUB)
+        try:
+            self.socket.bind(addr)
+        except zmq.ZMQError:
+            self.socket.close(linger=0)
+            self._context.term()
+            raise
+        # zmq sockets are not thread-safe
+        self.lock = threading.Lock()
+        self.log.info("Publish flow states on %s" % addr)
+
+    def publishFlow(self, flow_name, flow, reset=False):
+        """
+        publish the state of a root flow
+        @param reset: whether the states of all its jobs are cleaned up
+        """
+        build = flow.getattr('build')
+        self.publish("onFlowState",
+                     dict(flow=flow_name,
+                          status=flow.getattr('status'),
+                          build=build["number"] if build else None,
+                          url=build.get("full_url") if build else None,
+                          duration=flow.getattr('duration') or 0,
+                          reset=reset))
+
+    def publishJob(self, flow_name, job):
+        """
+        publish the state of a job instance in a root flow
+        """
+        build = job.build
+        self.publish("onJobState",
+                     dict(flow=flow_name,
+                          node=job.index,
+                          job=job.name,
+                          status=job.status,
+                          build=build["number"] if build else None,
+                          url=build.get("full_url") if build else None,
+                          duration=job.duration))
+
+    def publish(self, topic, data):
+        message = "%s %s" % (topic, json.dumps(data))
+        with self.lock:
+            if self.socket.closed:
+                return
+            self.socket.send(message.encode('utf-8'))
+
+    def close(self):
+        with self.lock:
+            self.log.debug("Stop publishing flow states on %s" % self.addr)
+            self.socket.close(linger=0)
+            self._context.term()
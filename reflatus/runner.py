@@ -1,9 +1,19 @@
 from reflatus.loader import Loader
-from reflatus.myjenkins import JenkinsManager
+from reflatus.myjenkins import JenkinsManager, DEFAULT_TIMEOUT
 from reflatus.events import ZMQListener
+from reflatus.shards import ShardedHandler
+from reflatus.discovery import FlowDiscoverer
+from reflatus.publisher import FlowStatePublisher
+from reflatus.stats import DurationStats
+from reflatus.journal import Journal, JournaledJenkins, MAX_BYTES, BACKUPS
 import ConfigParser
 import threading
 import logging
+import time
+
+
+# the default seconds to stop the backend, including draining the events
+SHUTDOWN_TIMEOUT = 10
 
 
 class Runner(threading.Thread):
@@ -16,10 +26,20 @@ class Runner(threading.Thread):
         @param config: the config file
         """
         threading.Thread.__init__(self, name="backend-runner")
+        self.daemon = True
         self.config = self._readConfig(config)
         self.flows, self.flow_map = self._getFlows()
+        self.journal = self._getJournal()
         self.jenkinsmgr = self._getJenkinsMgr()
-        self.zmq = self._getZMQ()
+        self.discoverer = self._getDiscoverer()
+        self.stats = self._getStats()
+        # the worker processes are forked before any zmq context
+        # starts its I/O threads
+        handler = self._getHandler()
+        self.publisher = self._getPublisher()
+        if handler:
+            handler.publisher = self.publisher
+        self.zmq = self._getZMQ(handler)
         self._stopped = False
 
     def _readConfig(self, filename):
@@ -36,25 +56,154 @@ class Runner(threading.Thread):
             flow_config = "./config/flows.yaml"
             self.log.info(" ".join(["Exception Occurred.",
                                     "Use default ./config/flows.yaml"]))
-        return Loader(flow_config).getConfig()
+        try:
+            flow_cache = self.config.get("flows", "cache")
+        except:
+            flow_cache = "%s.cache" % flow_config
+        self.log.info("Use flows' cache file: %s" % flow_cache)
+        return Loader(flow_config, flow_cache).getConfig()
 
     def _getJenkinsMgr(self):
         url = self.config.get("jenkins", "url")
         user = self.config.get("jenkins", "user")
         password = self.config.get("jenkins", "password")
-        return JenkinsManager(url, user, password)
+        try:
+            timeout = self.config.getint("jenkins", "timeout")
+        except:
+            timeout = DEFAULT_TIMEOUT
+        jenkinsmgr = JenkinsManager(url, user, password, timeout)
+        if self.journal:
+            return JournaledJenkins(jenkinsmgr, self.journal)
+        return jenkinsmgr
+
+    def _getJournal(self):
+        try:
+            path = self.config.get("journal", "path")
+        except:
+            return None
+        try:
+            max_bytes = self.config.getint("journal", "max_bytes")
+        except:
+            max_bytes = MAX_BYTES
+        try:
+            backups = self.config.getint("journal", "backups")
+        except:
+            backups = BACKUPS
+        return Journal(path, max_bytes, backups)
+
+    def _getDiscoverer(self):
+        try:
+            enabled = self.config.getboolean("flows", "discovery")
+        except:
+            enabled = False
+        if not enabled:
+            return None
+
+        try:
+            discovery_cache = self.config.get("flows", "discovery_cache")
+        except:
+            discovery_cache = "./config/discovered.yaml"
+        self.log.info("Discover flows into file: %s" % discovery_cache)
+        return FlowDiscoverer(discovery_cache, self.flows, self.flow_map)
+
+    def _getStats(self):
+        try:
+            stats_cache = self.config.get("flows", "stats_cache")
+        except:
+            stats_cache = "./config/stats.json"
+        self.log.info("Keep duration statistics in file: %s" % stats_cache)
+        return DurationStats(stats_cache)
+
+    def _getPublisher(self):
+        try:
+            addr = self.config.get("publish", "addr")
+        except:
+            return None
+        try:
+            return FlowStatePublisher(addr)
+        except Exception as excp:
+            # e.g. the address is still bound by another process
+            self.log.error(" ".join(["Unable to publish flow states",
+                                     "on %s: %s." % (addr, excp),
+                                     "Disable publishing."]))
+            return None
 
-    def _getZMQ(self):
+    def _getHandler(self):
+        """
+        @return: a ShardedHandler with worker processes, None to handle
+                 the events in the listener
+        """
+        name = self.config.get("zmq", "name")
+        try:
+            workers = self.config.getint("zmq", "workers")
+        except:
+            workers = 0
+        if workers <= 0:
+            return None
+
+        if self.discoverer:
+            self.log.warning(" ".join(["Discovery is not supported",
+                                       "with worker processes.",
+                                       "Disable it."]))
+            self.discoverer = None
+        self.log.info("Handle events in %d worker processes" % workers)
+        return ShardedHandler('%s-handler' % name,
+                              self.jenkinsmgr,
+                              self.flows,
+                              workers,
+                              stats=self.stats)
+
+    def _getZMQ(self, handler):
         name = self.config.get("zmq", "name")
         addr = self.config.get("zmq", "addr")
         return ZMQListener(name,
                            addr,
                            self.jenkinsmgr,
-                           self.flows)
+                           self.flows,
+                           self.discoverer,
+                           self.publisher,
+                           handler,
+                           self.journal,
+                           self.stats)
 
     def run(self):
         self.zmq.start()
 
+    def stop(self, timeout=SHUTDOWN_TIMEOUT):
+        """
+        stop the backend in order: stop receiving events, drain the queued
+        and running events within the timeout, and flush the state
+        @param timeout: the seconds to wait for the whole shutdown
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        self.log.info("Stop the backend within %s seconds" % timeout)
+        deadline = time.time() + timeout
+
+        self.zmq.stop()
+        if self.zmq.is_alive():
+            self.zmq.join(max(0, deadline - time.time()))
+
+        self.zmq.handler.stop(deadline)
+        if self.zmq.handler.is_alive():
+            self.zmq.handler.join(max(0, deadline - time.time()))
+
+        self.flush()
+        if self.publisher:
+            self.publisher.close()
+        if self.journal:
+            self.journal.close()
+        self.log.info("The backend is stopped.")
+
+    def flush(self):
+        """
+        persist the state kept in memory
+        """
+        if self.discoverer:
+            self.discoverer.flush()
+        self.stats.flush()
+
 
 if __name__ == "__main__":
     from reflatus.utils import setup_logging
@@ -0,0 +1,209 @@
+"""
+parse and schedule the events by priority
+"""
+import re
+import json
+import time
+import threading
+
+
+# priority classes of the events, the lower the earlier
+ROOT_FLOW = 0    # root flow starts, which cleanup the flows
+FINALIZED = 1    # finalizations of flows and jobs
+STARTED = 2      # starts of jobs
+STOPPED = 9      # the sentinel to stop handling, after all the events
+
+EVENT_PATTERN = re.compile(r"(on\w+) (\{.*\})", re.DOTALL)
+
+# the phases of a build, a build never goes back to an earlier phase
+PHASES = {"onStarted": 1,
+          "onFinalized": 2}
+
+# the number of the latest builds per job whose phases are kept,
+# the events of older builds are stale
+BUILD_WINDOW = 64
+
+
+class Event(object):
+    """
+    a parsed zmq event
+    """
+    def __init__(self, topic, data, received):
+        """
+        @param topic: the event topic, e.g. onStarted
+        @param data: the decoded event data
+        @param received: the timestamp receiving the event
+        """
+        self.topic = topic
+        self.data = data
+        self.name = data["name"]
+        self.build = data["build"]
+        self.received = received
+        # the timestamp the build started, if known from an earlier event
+        self.started = received
+        self.superseded = False
+
+    @classmethod
+    def parse(cls, event, received):
+        """
+        @param event: the raw zmq event, "<topic> <json data>"
+        """
+        topic, data = EVENT_PATTERN.match(event).groups()
+        return cls(topic, json.loads(data), received)
+
+    @property
+    def key(self):
+        return (self.name, self.build["number"])
+
+    def __repr__(self):
+        return "<Event {0.topic} {0.name}/{1}>".format(self,
+                                                       self.build["number"])
+
+
+class FlowGates(object):
+    """
+    sequence the events of a root flow after its cleanup,
+    without blocking the events of the other flows
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = dict()
+
+    def close(self, flow_name):
+        """
+        a cleanup of the flow is pending
+        """
+        with self._cond:
+            self._pending[flow_name] = self._pending.get(flow_name, 0) + 1
+
+    def open(self, flow_name):
+        """
+        a cleanup of the flow is done
+        """
+        with self._cond:
+            pending = self._pending.get(flow_name, 0) - 1
+            if pending > 0:
+                self._pending[flow_name] = pending
+            else:
+                self._pending.pop(flow_name, None)
+            self._cond.notify_all()
+
+    def wait(self, flow_name, timeout):
+        """
+        wait until no cleanup of the flow is pending
+        @return: False if timed out, otherwise True
+        """
+        with self._cond:
+            if flow_name not in self._pending:
+                return True
+            # Condition.wait(timeout) has no return value in python 2
+            deadline = time.time() + timeout
+            while flow_name in self._pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+
+class Watermarks(object):
+    """
+    the latest build numbers seen per root flow, and the phases of
+    the latest builds per job, to detect stale events in O(1) at ingest
+
+    When a root flow starts, the latest build seen of each of its jobs
+    is snapshotted: the builds up to it started before the current run
+    of the flow, so they can not belong to it.
+    """
+    def __init__(self, window=BUILD_WINDOW):
+        """
+        @param window: the number of the latest builds kept per job
+        """
+        self.window = window
+        self.flows = dict()
+        self.builds = dict()
+        self.floors = dict()
+        self.latest = dict()
+        # job name -> the root flows containing it
+        self.roots = dict()
+        # (root flow, job name) -> the latest job build when the flow started
+        self.snapshots = dict()
+        self.lock = threading.Lock()
+
+    def register(self, flow_name, job_names):
+        """
+        record the jobs of a root flow
+        """
+        with self.lock:
+            for name in job_names:
+                self.roots.setdefault(name, set()).add(flow_name)
+
+    def observe(self, event, isroot, job_names=None):
+        """
+        record an event if it is not stale
+        @param isroot: whether the event is from a root flow
+        @param job_names: the jobs of the root flow, if isroot
+        @return: False for a stale event, otherwise True
+        """
+        number = int(event.build["number"])
+        phase = PHASES[event.topic]
+        with self.lock:
+            if isroot and number < self.flows.get(event.name, number):
+                # a newer build of the root flow has been started
+                return False
+
+            if not isroot and self._predates(event.name, number):
+                # older than the current runs of all the flows of the job
+                return False
+
+            if number < self.floors.get(event.name, 0):
+                # an older build than all the kept builds
+                return False
+
+            phases = self.builds.setdefault(event.name, dict())
+            if phases.get(number, 0) >= phase:
+                # a duplicated event, or the build already finished
+                return False
+
+            phases[number] = phase
+            if len(phases) > self.window:
+                oldest = min(phases)
+                del phases[oldest]
+                self.floors[event.name] = oldest + 1
+            self.latest[event.name] = max(number,
+                                          self.latest.get(event.name, 0))
+
+            if isroot:
+                self.flows[event.name] = max(number,
+                                             self.flows.get(event.name, 0))
+                if event.topic == "onStarted":
+                    self._snapshot(event.name, job_names or ())
+            return True
+
+    def _snapshot(self, flow_name, job_names):
+        for name in job_names:
+            self.roots.setdefault(name, set()).add(flow_name)
+            self.snapshots[(flow_name, name)] = self.latest.get(name, 0)
+
+    def _predates(self, name, number):
+        roots = self.roots.get(name, None)
+        if not roots:
+            return False
+        # a flow not started yet has no snapshot, and keeps the event
+        return all(number <= self.snapshots.get((root, name), 0)
+                   for root in roots)
+
+    def getFlowBuild(self, flow_name):
+        """
+        get the latest build number of a root flow
+        @return: None if no build seen
+        """
+        return self.flows.get(flow_name, None)
+
+    def getPhase(self, name, number):
+        """
+        get the latest phase seen of a build
+        @return: None if not seen or out of the window
+        """
+        with self.lock:
+            return self.builds.get(name, dict()).get(int(number), None)
@@ -1,7 +1,25 @@
 from reflatus.web import Reflatus
-from flask import request, jsonify, render_template
+from reflatus.loader import Labeled
+from reflatus.state import STATUS_CODES, JobInstance
+from flask import request, jsonify, render_template, abort
+from six.moves.urllib.parse import quote
+import hashlib
+import json
+import zlib
 import os
 
+# the minimum size of the responses worth compressing
+COMPRESS_MIN_SIZE = 500
+COMPRESS_MIMETYPES = ("application/json", "text/html")
+# the flow structure url changes with its version, so cache it for long
+STRUCTURE_MAX_AGE = 86400
+STATUS_INDEX = dict((status, code)
+                    for (code, status) in enumerate(STATUS_CODES))
+# the finished statuses of a collapsed group, from the worst
+GROUP_STATUSES = ("failure", "aborted", "unstable", "success")
+# the maximum number of collapsed views cached per flow
+MAX_VIEWS = 32
+
 # change to real directory
 # used for relative path configuration in config.conf
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
@@ -24,7 +42,29 @@ def index():
                                               "liveflows/",
                                               flowname])])
     return render_template('index.html',
-                           flows_list=flows_list)
+                           flows_list=flows_list,
+                           overview_url="".join([url_root, "overview"]))
+
+
+@app.route("/overview")
+def overview():
+    """
+    show the aggregated status of all the flows
+    """
+    return render_template('overview.html',
+                           url_root=request.url_root)
+
+
+@app.route("/flowsummary")
+def flowsummary():
+    """
+    aggregated status of all the flows
+    used by ajax in js
+    """
+    summary = dict()
+    for (flowname, flow) in app.flows.items():
+        summary[flowname] = flow.summary.asdict()
+    return jsonify(summary)
 
 
 @app.route("/liveflows/<flowname>")
@@ -35,22 +75,15 @@ def livesingleflow(flowname):
     url_root = request.url_root
     title = flowname
 
-    try:
-        flow = convert_flow(app.flow_map[flowname])
-    except KeyError:
+    if flowname not in app.flows:
         ret_msg = " ".join(["Unable to find Flow <%s> in the" % flowname,
                             "back-end configuration file.",
                             "Please check the validity of your flow name."])
         return ret_msg
-    except Exception as excp:
-        ret_msg = " ".join(["Unable to handle Flow <%s> with" % flowname,
-                            "the following message: %s." % excp,
-                            "Please contact the back-end administrator."])
-        return ret_msg
 
+    # a skeleton, the flow structure and state are fetched lazily
     return render_template('live_flowmap.html',
                            title=title,
-                           flow=flow,
                            url_root=url_root)
 
 
@@ -64,6 +97,88 @@ def flowsupdated(flowname):
     return jsonify(flow)
 
 
+@app.route("/flowstructure/<flowname>")
+def flowstructure(flowname):
+    """
+    static structure of a certain flowname in the compact format
+    cached by the browser until the structure version changes
+    """
+    try:
+        structure = convert_structure(flowname, get_expanded())
+    except KeyError:
+        abort(404)
+    response = compact_json(structure)
+    response.cache_control.public = True
+    response.cache_control.max_age = STRUCTURE_MAX_AGE
+    response.set_etag(structure["version"], weak=True)
+    return response.make_conditional(request)
+
+
+@app.route("/flowstate/<flowname>")
+def flowstate(flowname):
+    """
+    dynamic state of a certain flowname in the compact format
+    used by ajax in js
+    """
+    try:
+        state = convert_state(flowname, get_expanded())
+    except KeyError:
+        abort(404)
+    response = compact_json(state)
+    response.cache_control.no_cache = True
+    return response
+
+
+def get_expanded():
+    """
+    the labeled groups to expand in the requested view of a flow,
+    with ?collapse=1&expand=<group>,<group>
+    @return: None for the full flow
+    """
+    if request.args.get("collapse") != "1":
+        return None
+    expand = request.args.get("expand", "")
+    return frozenset(group for group in expand.split(",") if group)
+
+
+def compact_json(data):
+    """
+    jsonify without indentation and whitespaces
+    """
+    return app.response_class(json.dumps(data, separators=(",", ":")),
+                              mimetype="application/json")
+
+
+@app.after_request
+def compress(response):
+    """
+    compress the response with gzip or deflate if the client accepts it
+    """
+    if response.status_code != 200 or response.direct_passthrough or \
+            "Content-Encoding" in response.headers or \
+            response.mimetype not in COMPRESS_MIMETYPES:
+        return response
+
+    accept_encoding = request.headers.get("Accept-Encoding", "").lower()
+    if "gzip" in accept_encoding:
+        encoding = "gzip"
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif "deflate" in accept_encoding:
+        encoding = "deflate"
+        compressor = zlib.compressobj(6)
+    else:
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    response.set_data(compressor.compress(data) + compressor.flush())
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
 def convert_flow(flow):
     """
     Convert the obj info to dict
@@ -71,9 +186,218 @@ def convert_flow(flow):
     """
     newflow = dict()
     for (job_name, job_info) in flow.iteritems():
-        newflow[job_name] = job_info.__dict__
+        newflow[job_name] = job_info.asdict()
     return newflow
 
+
+# flowname -> (flow, {expanded groups: view}),
+# refreshed when the flow is replaced
+_structures = dict()
+
+
+def get_groups(jobs, parent=None, groups=None):
+    """
+    get the labeled groups of a flow, outer groups first
+    A group holds the consecutive job instances expanded from a labeled
+    flow, and is identified by its label and its first instance.
+    @param jobs: the job instances tree of the flow
+    @return: a list of dict(id, label, parent, first, last)
+    """
+    if groups is None:
+        groups = list()
+    if isinstance(jobs, JobInstance):
+        return groups
+
+    span = get_span(jobs)
+    if isinstance(jobs, Labeled) and span:
+        group_id = "%s@%d" % (jobs.label, span[0])
+        groups.append(dict(id=group_id,
+                           label=jobs.label,
+                           parent=parent,
+                           first=span[0],
+                           last=span[1]))
+        parent = group_id
+    for job in jobs:
+        get_groups(job, parent, groups)
+    return groups
+
+
+def get_span(jobs):
+    """
+    get the indexes of the first and the last instances of a jobs tree
+    @return: None if it has no instances
+    """
+    first = get_edge(jobs, iter)
+    if first is None:
+        return None
+    return (first.index, get_edge(jobs, reversed).index)
+
+
+def get_edge(jobs, order):
+    """
+    get the first instance of a jobs tree in an order, skipping
+    the empty blocks
+    @param order: iter for the first instance, reversed for the last one
+    """
+    if isinstance(jobs, JobInstance):
+        return jobs
+    for block in order(jobs):
+        instance = get_edge(block, order)
+        if instance is not None:
+            return instance
+    return None
+
+
+def convert_structure(flowname, expanded=None):
+    """
+    Convert the static structure of a flow to the compact format
+    The nodes are identified by their index in the flow.
+    @param flowname: the name of the flow
+    @param expanded: the labeled groups to expand, the others are
+                     collapsed into aggregate nodes; None for the full flow
+    """
+    return get_view(flowname, expanded)[0]
+
+
+def get_view(flowname, expanded=None):
+    """
+    get a view of a flow
+    @return: (the structure, the range of the job instances represented
+              by each node, the previous instances of each instance)
+    """
+    flow = app.flows[flowname]
+    cached = _structures.get(flowname, None)
+    if cached is None or cached[0] is not flow:
+        cached = _structures[flowname] = (flow, dict())
+    views = cached[1]
+    view = views.get(expanded, None)
+    if view is not None:
+        return view
+
+    jenkins_url = app.runner.jenkinsmgr.baseurl.rstrip("/")
+    previous = flow.previous
+
+    # the group collapsing each instance, and its innermost expanded group
+    collapsed = [None] * len(flow.instances)
+    opened = [None] * len(flow.instances)
+    if expanded is not None:
+        visible = set([None])
+        for group in get_groups(flow.jobs):
+            if group["parent"] not in visible:
+                continue
+            members = range(group["first"], group["last"] + 1)
+            if group["id"] in expanded:
+                visible.add(group["id"])
+                for index in members:
+                    opened[index] = group["id"]
+            else:
+                for index in members:
+                    collapsed[index] = group
+
+    nodes = list()
+    ranges = list()
+    node_of = list()
+    for (index, job) in enumerate(flow.instances):
+        group = collapsed[index]
+        if group is not None and index != group["first"]:
+            node_of.append(node_of[-1])
+            continue
+        node_of.append(len(nodes))
+        if group is None:
+            ranges.append((index, index))
+            nodes.append(dict(name=job.name,
+                              description=job.description,
+                              url="%s/job/%s/" % (jenkins_url,
+                                                  quote(job.name))))
+            if opened[index]:
+                nodes[-1]["group"] = opened[index]
+        else:
+            ranges.append((group["first"], group["last"]))
+            nodes.append(dict(name=group["label"],
+                              description=None,
+                              url=None,
+                              group=group["id"],
+                              count=group["last"] - group["first"] + 1))
+
+    for (node, (first, last)) in zip(nodes, ranges):
+        node["previous"] = sorted(set(node_of[prev]
+                                      for index in range(first, last + 1)
+                                      for prev in previous[index]
+                                      if not first <= prev <= last))
+
+    structure = dict(statuses=STATUS_CODES, nodes=nodes)
+    structure["version"] = hashlib.sha1(
+        json.dumps(structure, sort_keys=True)).hexdigest()[:12]
+    if len(views) >= MAX_VIEWS:
+        views.clear()
+    view = views[expanded] = (structure, ranges, previous)
+    return view
+
+
+def convert_state(flowname, expanded=None):
+    """
+    Convert the dynamic state of a flow to the compact format
+    status codes, build numbers, durations and progress indexed by node,
+    with the estimated remaining seconds of the flow
+    @param flowname: the name of the flow
+    @param expanded: the expanded labeled groups of the view,
+                     None for the full flow
+    """
+    flow = app.flows[flowname]
+    (structure, ranges, _) = get_view(flowname, expanded)
+    (eta, progress, late) = app.runner.stats.estimateFlow(flow)
+    late = set(late)
+    statuses = list()
+    builds = list()
+    durations = list()
+    node_progress = list()
+    node_late = list()
+    for (node, (first, last)) in enumerate(ranges):
+        if first == last:
+            job = flow.instances[first]
+            statuses.append(STATUS_INDEX.get(job.status, 0))
+            builds.append(job.build["number"] if job.build else 0)
+            durations.append(int(job.duration or 0))
+            node_progress.append(progress.get(first, None))
+        else:
+            jobs = flow.instances[first:last + 1]
+            status = aggregate_status([job.status for job in jobs],
+                                      flow.summary.status == "running")
+            statuses.append(STATUS_INDEX.get(status, 0))
+            builds.append(0)
+            durations.append(int(sum(job.duration or 0 for job in jobs)))
+            finished = len([job for job in jobs
+                            if job.status and job.status != "running"])
+            node_progress.append(100 * finished / len(jobs)
+                                 if status == "running" else None)
+        if any(index in late for index in range(first, last + 1)):
+            node_late.append(node)
+    return dict(v=structure["version"],
+                s=statuses,
+                b=builds,
+                d=durations,
+                p=node_progress,
+                l=node_late,
+                fs=STATUS_INDEX.get(flow.summary.status, 0),
+                fb=flow.summary.build,
+                fe=eta)
+
+
+def aggregate_status(statuses, running):
+    """
+    the status of a collapsed group from the statuses of its jobs
+    @param running: whether the flow is running
+    """
+    started = [status for status in statuses if status]
+    if not started:
+        return None
+    if "running" in started or (running and len(started) < len(statuses)):
+        return "running"
+    for status in GROUP_STATUSES:
+        if status in started:
+            return status
+    return started[0]
+
 if __name__ == "__main__":
     from reflatus.utils import setup_logging
     setup_logging()
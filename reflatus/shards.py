@@ -0,0 +1,351 @@
+"""
+process the events in worker processes, sharded by root flow
+"""
+import re
+import json
+import time
+import zlib
+import signal
+import logging
+import threading
+import collections
+import multiprocessing
+from six.moves import queue as Queue
+from reflatus.events import EventsHandler, POLL_TIMEOUT, MAX_QUEUE
+from reflatus.myjenkins import JenkinsManager
+from reflatus.publisher import FlowStatePublisher
+from reflatus.scheduler import Event
+from reflatus.utils import StoppedException
+
+
+# the topic and the job name of a raw event, matched without decoding
+# the whole json, since the zmq-event-publisher serializes the name first
+ROUTE_PATTERN = re.compile(r'(on\w+) \{\s*"name"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+TOPICS = ('onStarted', 'onFinalized')
+
+# the seconds between the attempts of a worker to connect to jenkins
+CONNECT_INTERVAL = 5
+
+
+def getShard(flow_name, workers):
+    """
+    get the worker owning a root flow, stable across restarts
+    """
+    return (zlib.crc32(flow_name.encode('utf-8')) & 0xffffffff) % workers
+
+
+class ShardPublisher(FlowStatePublisher):
+    """
+    send the flow state changes of a worker to the main process,
+    in the same format as they are published
+    """
+    log = logging.getLogger('shards.ShardPublisher')
+
+    def __init__(self, outbox):
+        """
+        @param outbox: the queue read by the main process
+        """
+        self.outbox = outbox
+
+    def publish(self, topic, data):
+        self.outbox.put((topic, data))
+
+    def close(self):
+        pass
+
+
+def connectJenkins(index, jenkins_args, inbox, received):
+    """
+    connect a worker to jenkins, retrying until it is reachable
+    @param received: the deque keeping the latest events received meanwhile
+    @return: (the JenkinsManager or None,
+              the stop message if received meanwhile or None)
+    """
+    log = logging.getLogger('shards.connectJenkins')
+    failed = False
+    while True:
+        try:
+            jenkinsmgr = JenkinsManager(*jenkins_args)
+        except Exception as excp:
+            if not failed:
+                log.error(" ".join(["Worker %d is unable to" % index,
+                                    "connect to Jenkins: %s." % excp,
+                                    "Retry every %ds." % CONNECT_INTERVAL]))
+            failed = True
+        else:
+            if failed:
+                log.info("Worker %d connected to Jenkins." % index)
+            return (jenkinsmgr, None)
+
+        retry = time.time() + CONNECT_INTERVAL
+        while time.time() < retry:
+            try:
+                event = inbox.get(timeout=max(0, retry - time.time()))
+            except Queue.Empty:
+                break
+            if isinstance(event, tuple):
+                return (None, event)
+            received.append(event)
+
+
+def runShard(index, jenkins_args, flows, external, inbox, outbox):
+    """
+    the main loop of a worker process, handling the events of its flows
+    @param jenkins_args: the arguments to create a JenkinsManager
+    @param flows: the root flows owned by the worker
+    @param external: the root flows owned by the other workers
+    """
+    # the main process coordinates the shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log = logging.getLogger('shards.runShard')
+    log.info("Worker %d handles %d flows" % (index, len(flows)))
+    handler = None
+    deadline = None
+    try:
+        # the oldest events are dropped while jenkins is unreachable
+        received = collections.deque(maxlen=MAX_QUEUE)
+        (jenkinsmgr, stop) = connectJenkins(index, jenkins_args, inbox,
+                                            received)
+        if stop is not None:
+            return
+        handler = EventsHandler("shard-%d" % index,
+                                jenkinsmgr,
+                                flows,
+                                None,
+                                ShardPublisher(outbox),
+                                external)
+        handler.start()
+        for event in received:
+            handler.submitEvent(event)
+        while True:
+            event = inbox.get()
+            if isinstance(event, tuple):
+                # ("stop", deadline)
+                deadline = event[1]
+                break
+            handler.submitEvent(event)
+    except Exception as excp:
+        log.exception("Worker %d failed: %s" % (index, excp))
+    finally:
+        if handler is not None:
+            handler.stop(deadline)
+            if deadline is None:
+                handler.join()
+            else:
+                handler.join(max(0, deadline - time.time()))
+        outbox.put(None)
+
+
+class ShardedHandler(threading.Thread):
+    """
+    events handler dispatching the events to worker processes
+
+    Each worker owns the state of the root flows hashed to it, and runs
+    its own EventsHandler. The events of a job are routed to the workers
+    owning the flows which contain it, the others are dropped without
+    being decoded. The workers send back their state changes, which are
+    applied to the flows read by the web layer and republished.
+    """
+    log = logging.getLogger("shards.ShardedHandler")
+
+    def __init__(self, name, jenkinsmgr, flows, workers, publisher=None,
+                 stats=None):
+        """
+        @param jenkinsmgr: JenkinsManager instance, whose settings are
+                           used by the workers to connect to jenkins
+        @param flows: flows object, updated with the state of the workers
+        @param workers: the number of worker processes
+        @param publisher: FlowStatePublisher instance, None to disable
+                          republishing the flow states
+        @param stats: DurationStats instance, None to disable the statistics
+        """
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.name = name
+        self.flows = flows
+        self.workers = workers
+        self.publisher = publisher
+        self.stats = stats
+        self.routes = self._getRoutes()
+        self.outbox = multiprocessing.Queue()
+        self.inboxes = list()
+        self.processes = list()
+        # the workers which exited unexpectedly, no longer routed to
+        self.dead = set()
+        self._checked = time.time()
+        self._stopped = False
+        self._deadline = None
+        self._startWorkers((jenkinsmgr.baseurl,
+                            jenkinsmgr.username,
+                            jenkinsmgr.password,
+                            jenkinsmgr.timeout))
+
+    def _getRoutes(self):
+        """
+        map the names of the root flows and their jobs to the workers
+        """
+        routes = dict()
+        for (flow_name, flow) in self.flows.iteritems():
+            shard = getShard(flow_name, self.workers)
+            routes.setdefault(flow_name, set()).add(shard)
+            for name in flow.index:
+                routes.setdefault(name, set()).add(shard)
+        return dict((name, sorted(shards))
+                    for (name, shards) in routes.iteritems())
+
+    def _startWorkers(self, jenkins_args):
+        """
+        the workers are forked when the handler is created, which must
+        happen before any thread is started in the process, including the
+        I/O threads of a zmq context, since forking a multi-threaded process
+        is unsafe: e.g. create the publisher after the handler
+        """
+        for index in range(self.workers):
+            flows = dict((flow_name, flow)
+                         for (flow_name, flow) in self.flows.iteritems()
+                         if getShard(flow_name, self.workers) == index)
+            external = frozenset(self.flows) - frozenset(flows)
+            inbox = multiprocessing.Queue()
+            process = multiprocessing.Process(target=runShard,
+                                              name="%s-%d" % (self.name,
+                                                              index),
+                                              args=(index,
+                                                    jenkins_args,
+                                                    flows,
+                                                    external,
+                                                    inbox,
+                                                    self.outbox))
+            process.daemon = True
+            process.start()
+            self.inboxes.append(inbox)
+            self.processes.append(process)
+        self.log.info("Handler %s started %d workers"
+                      % (self.name, self.workers))
+
+    def run(self):
+        self.log.debug('Handler %s Starts Applying States' % self.name)
+        running = len(self.processes)
+        while running:
+            self._checkWorkers()
+            try:
+                state = self.outbox.get(timeout=POLL_TIMEOUT / 1000.0)
+            except Queue.Empty:
+                if self._deadline and time.time() > self._deadline:
+                    break
+                if not any(process.is_alive()
+                           for process in self.processes):
+                    self._checkWorkers(force=True)
+                    break
+                continue
+            if state is None:
+                running -= 1
+                continue
+            try:
+                self.applyState(*state)
+            except Exception as excp:
+                self.log.exception("Handler %s failed to apply %r: %s"
+                                   % (self.name, state, excp))
+
+        for process in self.processes:
+            if self._deadline is None:
+                process.join()
+            else:
+                process.join(max(0, self._deadline - time.time()))
+            if process.is_alive():
+                self.log.warning("Handler %s terminates worker %s."
+                                 % (self.name, process.name))
+                process.terminate()
+        self.log.debug('Handler %s Stops Applying States' % self.name)
+
+    def _checkWorkers(self, force=False):
+        """
+        stop routing the events to the workers which exited unexpectedly,
+        their flows are no longer updated. They are not restarted since
+        forking this multi-threaded process is unsafe
+        @param force: check now, instead of at most every POLL_TIMEOUT
+        """
+        if self._stopped:
+            return
+        if not force and time.time() - self._checked < POLL_TIMEOUT / 1000.0:
+            return
+        self._checked = time.time()
+        for (index, process) in enumerate(self.processes):
+            if index in self.dead or process.is_alive():
+                continue
+            self.dead.add(index)
+            self.log.error(" ".join(["Handler %s lost worker" % self.name,
+                                     "%s with exit code %s." % (
+                                         process.name, process.exitcode),
+                                     "Its flows are no longer updated."]))
+
+    def stop(self, deadline=None):
+        """
+        stop accepting events, the workers drain their events
+        until the deadline
+        @param deadline: the timestamp to give up draining, None for never
+        """
+        self._stopped = True
+        self._deadline = deadline
+        for inbox in self.inboxes:
+            inbox.put(("stop", deadline))
+
+    def submitEvent(self, event, received=None):
+        """
+        route a raw zmq event to the workers owning its flows
+        @param received: unused, the workers time their received events
+        """
+        if self._stopped:
+            raise StoppedException("Handler %s is no longer running"
+                                   % self.name)
+        match = ROUTE_PATTERN.match(event)
+        if match:
+            (topic, name) = match.groups()
+            if '\\' in name:
+                name = json.loads('"%s"' % name)
+        else:
+            try:
+                parsed = Event.parse(event, None)
+            except Exception as excp:
+                self.log.error("Unable to parse event %r: %s"
+                               % (event, excp))
+                return
+            (topic, name) = (parsed.topic, parsed.name)
+
+        if topic not in TOPICS:
+            return
+        for shard in self.routes.get(name, ()):
+            if shard not in self.dead:
+                self.inboxes[shard].put(event)
+
+    def applyState(self, topic, data):
+        """
+        apply a state change of a worker to the flows
+        """
+        flow = self.flows.get(data["flow"], None)
+        if flow is None:
+            return
+
+        build = None
+        if data["build"]:
+            build = dict(number=data["build"], full_url=data["url"])
+        if topic == "onFlowState":
+            if data["reset"]:
+                for job in flow.instances:
+                    job.reset()
+            flow.build = build
+            flow.status = data["status"]
+            flow.duration = data["duration"]
+            flow.summary.flowChanged(build, data["status"])
+        elif topic == "onJobState":
+            job = flow.instances[data["node"]]
+            job.update(build, data["status"], data["duration"])
+            if self.stats and data["status"] != "running" and \
+                    data["duration"] is not None:
+                self.stats.observe(data["flow"], job, data["duration"])
+
+        if self.stats:
+            self.stats.planFlow(data["flow"], flow)
+
+        if self.publisher:
+            self.publisher.publish(topic, data)
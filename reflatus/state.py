@@ -0,0 +1,169 @@
+"""
+runtime state of the jobs in the flows
+"""
+import time
+
+
+# the status codes used by the compact wire format
+STATUS_CODES = [None, "running", "success", "failure", "aborted", "unstable"]
+
+
+class JobInstance(object):
+    """
+    the live state of a job within a certain flow
+
+    The job definition (JobConfig) is shared by all the flows referencing
+    the same (labeled) jobs, while each flow owns its own instances, so
+    that updating or cleaning up one flow never touches another.
+    """
+    __slots__ = ('definition', 'summary', 'index', 'previous',
+                 'build', 'status', 'duration', 'started')
+
+    def __init__(self, definition, summary=None):
+        """
+        @param definition: the shared JobConfig of the job
+        @param summary: the FlowSummary of the flow owning the instance
+        """
+        self.definition = definition
+        self.summary = summary
+        self.index = None
+        self.previous = None
+        self.build = None
+        self.status = None
+        self.duration = 0
+        self.started = None
+
+    def __repr__(self):
+        return "<Job {0.name} 0x{1:x}>".format(self, id(self))
+
+    @property
+    def name(self):
+        return self.definition.name
+
+    @property
+    def description(self):
+        return self.definition.getattr('description')
+
+    @property
+    def label(self):
+        return self.definition.getattr('label')
+
+    @property
+    def labeledBy(self):
+        return self.definition.getattr('labeledBy')
+
+    @property
+    def identifier(self):
+        return self.definition.getattr('identifier')
+
+    def update(self, build, status, duration, timestamp=None):
+        """
+        update the build status
+        @param timestamp: the time the status changed, now by default
+        """
+        if self.summary:
+            self.summary.jobChanged(self.status, status)
+        if status == "running":
+            self.started = timestamp or time.time()
+        self.build = build
+        self.status = status
+        self.duration = duration
+
+    def reset(self):
+        """
+        cleanup the build status and info
+        """
+        if self.summary:
+            self.summary.jobChanged(self.status, None)
+        self.build = None
+        self.status = None
+        self.duration = 0
+        self.started = None
+
+    def asdict(self):
+        """
+        convert the definition and the state into a dict
+        """
+        info = dict(self.definition.__dict__)
+        info.update(previous=self.previous,
+                    build=self.build,
+                    status=self.status,
+                    duration=self.duration)
+        return info
+
+
+class FlowSummary(object):
+    """
+    the aggregated status of a flow
+
+    The counts of the jobs per status are maintained on every job
+    state change, so that reporting a flow never iterates its jobs.
+    Likewise the estimate of the remaining time is planned on every
+    state change by DurationStats.planFlow.
+    """
+    def __init__(self, total):
+        """
+        @param total: the number of the job instances of the flow
+        """
+        self.total = total
+        self.counts = {"stopped": total}
+        self.build = None
+        self.status = None
+        self.started = None
+        self.finished = None
+        self.estimate = None
+
+    def jobChanged(self, old_status, new_status):
+        """
+        move a job from the old status to the new status
+        """
+        old_status = old_status or "stopped"
+        new_status = new_status or "stopped"
+        if old_status == new_status:
+            return
+        self.counts[old_status] = self.counts.get(old_status, 0) - 1
+        self.counts[new_status] = self.counts.get(new_status, 0) + 1
+
+    def flowChanged(self, build, status, timestamp=None):
+        """
+        update the build info and status of the flow
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        self.build = build["number"] if build else None
+        self.status = status
+        if status == "running":
+            self.started = timestamp
+            self.finished = None
+        elif status:
+            if self.started is None:
+                self.started = timestamp
+            self.finished = timestamp
+        else:
+            self.started = None
+            self.finished = None
+
+    @property
+    def elapsed(self):
+        """
+        the elapsed seconds of the current build
+        """
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    def asdict(self):
+        """
+        convert the summary into a dict
+        """
+        counts = dict((status, count)
+                      for (status, count) in self.counts.iteritems()
+                      if count)
+        running = counts.get("running", 0)
+        stopped = counts.get("stopped", 0)
+        return dict(status=self.status,
+                    build=self.build,
+                    total=self.total,
+                    finished=self.total - running - stopped,
+                    counts=counts,
+                    elapsed=int(self.elapsed))
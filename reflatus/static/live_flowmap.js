@@ -11,6 +11,19 @@ function drawflow(){
 
     var render = new dagreD3.render();
 
+    // the laid out graph, the structure version it was laid out for,
+    // and the rendered class/label of each node
+    var g = null;
+    var version = null;
+    var rendered = {};
+    var jobs = {};
+
+    // the flow is fetched lazily, with its labeled groups collapsed
+    // until they are expanded on demand
+    var structure = null;
+    var state = null;
+    var expanded = [];
+
     // function to format string
     String.prototype.format = function()
     {
@@ -18,14 +31,83 @@ function drawflow(){
        for (var i=0; i < arguments.length; i++)
        {
             var replacement = '{' + i + '}';
-            content = content.replace(replacement, arguments[i]);  
+            content = content.replace(replacement, arguments[i]);
        }
        return content;
     };
 
-    function draw() {
+    function getClassName(job) {
+        var className = "stopped";
+        if (job.status) {
+            className = job.status;
+            if (className == "running") {
+                className += " warn";
+            }
+            if (job.late) {
+                className += " late";
+            }
+        }
+        return className;
+    }
+
+    // the status text is always in the same fixed-width slots, so that
+    // the label boxes never change size and are only laid out once
+    function getLabel(job) {
+        var slots = ["", "", ""];
+        var name = job.name;
+        if (job.count) {
+            name = "[+] " + name;
+            slots[0] = "{0} jobs".format(job.count);
+            if (job.progress != null) {
+                slots[1] = "{0}% done".format(job.progress);
+                }
+        } else if (job.build) {
+            slots[0] = "<a href='{0}'>#{1}</a>".format(job.build.full_url, job.build.number);
+            if (job.duration) {
+                slots[1] = "{0}sec".format(job.duration);
+                }
+            if (job.status == "running" && job.progress != null) {
+                slots[2] = "~{0}%".format(job.progress);
+                }
+            }
+
+        var html = "<div>";
+        html += "<span class=status></span>";
+        html += "<span class=name>"+name+"</span>";
+        for (var i = 0; i < slots.length; i++) {
+            html += "<span class=buildurl>"+slots[i]+"</span>";
+            }
+        html += "</div>";
+        return html;
+    }
+
+    // rebuild the jobs from the compact structure and state,
+    // where the nodes are identified by their index
+    function decode() {
+        jobs = {};
+        var nodes = structure.nodes;
+        for (var i = 0; i < nodes.length; i++) {
+            var node = nodes[i];
+            var number = state.b[i];
+            jobs[i] = {
+                name: node.name,
+                group: node.group,
+                count: node.count,
+                previous: node.previous,
+                status: structure.statuses[state.s[i]],
+                duration: state.d[i],
+                progress: state.p[i],
+                late: state.l.indexOf(i) >= 0,
+                build: number ? {number: number,
+                                 full_url: node.url + number + "/"} : null
+                };
+            }
+    }
+
+    // full layout, only needed when the flow structure changes
+    function layout() {
         // Left-to-right layout
-        var g = new dagreD3.graphlib.Graph();
+        g = new dagreD3.graphlib.Graph();
         g.setGraph({
             nodesep: 50,
             ranksep: 20,
@@ -34,30 +116,13 @@ function drawflow(){
             marginy: 20
             });
 
+        rendered = {};
         for (var id in jobs) {
             var job = jobs[id];
-            var className = "stopped";
-            if (job.status) {
-                className = job.status;
-                if (className == "running") {
-                    className += " warn";
-                }
-            }
-
-            var html = "<div>";
-            html += "<span class=status></span>";
-            html += "<span class=name>"+job.name+"</span>";
-
-            if (job.build) {
-                html += "<span class=buildurl><a href='{0}'>#{1}</a></span>".format(job.build.full_url, job.build.number);
-
-                if (job.duration) {
-                    html += "<span class=buildurl>{0}sec</span>".format(job.duration);
-                    }
+            var className = getClassName(job);
+            var html = getLabel(job);
+            rendered[id] = className + html;
 
-                }
-
-            html += "</div>";
             g.setNode(id, {
                 labelType: "html",
                 label: html,
@@ -77,7 +142,7 @@ function drawflow(){
                 }
             }
 
-        inner.call(render, g);
+        renderGraph();
 
         // Zoom and scale to fit
         var zoomScale = zoom.scale();
@@ -92,18 +157,110 @@ function drawflow(){
         zoom.event(d3.select("svg"));
         }
 
-    // Do some status updates
-    setInterval(function() {
-        //Get some updated values from the server
-        $.getJSON(url_root + 'flowdata/{0}'.format(flow_name),  // At this URL
-                  {},                         // With no extra parameters
+    // render the nodes, which sizes the label boxes
+    // and lays out the nodes around them
+    function renderGraph() {
+        inner.call(render, g);
+
+        // expand a collapsed group, or collapse the group of a job
+        inner.selectAll("g.node").on("click", function(id) {
+            if (d3.event.target.tagName == "A") {
+                return;
+                }
+            var job = jobs[id];
+            if (!job.group) {
+                return;
+                }
+            var i = expanded.indexOf(job.group);
+            if (job.count && i < 0) {
+                expanded.push(job.group);
+            } else if (!job.count && i >= 0) {
+                expanded.splice(i, 1);
+            } else {
+                return;
+                }
+            fetchStructure();
+            });
+        }
+
+    // patch the class and the label of the changed nodes only,
+    // the labels keep the size of their boxes
+    function patch() {
+        for (var id in jobs) {
+            var job = jobs[id];
+            var className = getClassName(job);
+            var html = getLabel(job);
+            if (rendered[id] == className + html) {
+                continue;
+                }
+            rendered[id] = className + html;
+
+            var node = g.node(id);
+            node.class = className;
+            node.label = html;
+
+            var elem = d3.select(node.elem);
+            elem.attr("class", "node " + className);
+            elem.select("foreignObject div").html(html);
+            }
+        }
+
+    function formatEta(seconds) {
+        if (seconds == null) {
+            return "";
+        }
+        var minutes = Math.floor(seconds / 60);
+        return "ETA: ~{0}m {1}s".format(minutes, seconds % 60);
+    }
+
+    function draw() {
+        decode();
+        d3.select("#eta").text(formatEta(state.fe));
+        if (version != structure.version) {
+            version = structure.version;
+            layout();
+        } else {
+            patch();
+        }
+    }
+
+    function getParams() {
+        return {collapse: 1, expand: expanded.join(",")};
+    }
+
+    // the version busts the browser cache once the structure changed
+    function fetchStructure(v) {
+        var params = getParams();
+        if (v) {
+            params.v = v;
+        }
+        $.getJSON(url_root + 'flowstructure/{0}'.format(flow_name),
+                  params,
+                  function(data) {
+                      structure = data;
+                      fetchState();
+                  });
+    }
+
+    function fetchState() {
+        $.getJSON(url_root + 'flowstate/{0}'.format(flow_name),
+                  getParams(),
                   function(data) {
-                      // Update the graph
-                      if (jobs!=data) {
-                          jobs = data;
-                          draw();
+                      state = data;
+                      if (state.v != structure.version) {
+                          // the structure changed, fetch it once (cacheable)
+                          fetchStructure(state.v);
+                          return;
                       }
+                      draw();
                   });
+    }
+
+    // Do some status updates
+    setInterval(function() {
+        if (structure) {
+            fetchState();
+        }
         }, 5000);
-    draw();
+    fetchStructure();
     }
@@ -0,0 +1,51 @@
+function drawoverview(){
+
+    var tbody = $("table.overview tbody");
+    var rows = {};
+
+    function formatElapsed(seconds) {
+        var minutes = Math.floor(seconds / 60);
+        if (minutes == 0) {
+            return seconds + "sec";
+        }
+        return minutes + "min " + (seconds % 60) + "sec";
+    }
+
+    function draw(flows) {
+        var names = Object.keys(flows).sort();
+        for (var i = 0; i < names.length; i++) {
+            var name = names[i];
+            var flow = flows[name];
+            var row = rows[name];
+            if (!row) {
+                row = $("<tr>" +
+                        "<td class=status></td>" +
+                        "<td class=name><a></a></td>" +
+                        "<td class=build></td>" +
+                        "<td class=progress></td>" +
+                        "<td class=elapsed></td>" +
+                        "</tr>");
+                row.find("a").attr("href", url_root + "liveflows/" + name)
+                             .text(name);
+                tbody.append(row);
+                rows[name] = row;
+            }
+
+            var className = flow.status || "stopped";
+            if (className == "running") {
+                className += " warn";
+            }
+            row.attr("class", className);
+            row.find(".build").text(flow.build ? "#" + flow.build : "");
+            row.find(".progress").text(flow.finished + "/" + flow.total);
+            row.find(".elapsed").text(flow.status ? formatElapsed(flow.elapsed) : "");
+            }
+        }
+
+    function update() {
+        $.getJSON(url_root + "flowsummary", {}, draw);
+        }
+
+    setInterval(update, 5000);
+    update();
+    }
@@ -0,0 +1,301 @@
+"""
+streaming duration statistics of the jobs, and the ETA of the flows
+"""
+import os
+import json
+import time
+import threading
+import logging
+
+
+# the weight of the latest duration in the moving average
+EWMA_ALPHA = 0.3
+# the quantiles estimated per job
+QUANTILES = (0.5, 0.9)
+# a running job is late once it runs longer than this quantile
+LATE_QUANTILE = 0.9
+
+
+class P2Quantile(object):
+    """
+    estimate a quantile in constant memory with the P-square algorithm
+    (Jain and Chlamtac, 1985), keeping five markers instead of the samples
+    """
+    __slots__ = ('p', 'heights', 'positions', 'desired')
+
+    def __init__(self, p):
+        self.p = p
+        self.heights = list()
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+
+    @property
+    def increments(self):
+        return (0, self.p / 2, self.p, (1 + self.p) / 2, 1)
+
+    def observe(self, value):
+        heights = self.heights
+        if len(heights) < 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+
+        positions = self.positions
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        increments = self.increments
+        for i in range(5):
+            self.desired[i] += increments[i]
+
+        # adjust the middle markers towards their desired positions
+        for i in range(1, 4):
+            delta = self.desired[i] - positions[i]
+            if (delta >= 1 and positions[i + 1] - positions[i] > 1) or \
+                    (delta <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if delta > 0 else -1
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self._linear(i, step)
+                heights[i] = height
+                positions[i] += step
+
+    def _parabolic(self, i, step):
+        (q, n) = (self.heights, self.positions)
+        return q[i] + float(step) / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def _linear(self, i, step):
+        (q, n) = (self.heights, self.positions)
+        return q[i] + step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+
+    @property
+    def value(self):
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            index = int(round((len(self.heights) - 1) * self.p))
+            return self.heights[index]
+        return self.heights[2]
+
+    def asdict(self):
+        return dict(p=self.p,
+                    heights=self.heights,
+                    positions=self.positions,
+                    desired=self.desired)
+
+    @classmethod
+    def fromdict(cls, data):
+        quantile = cls(data["p"])
+        quantile.heights = data["heights"]
+        quantile.positions = data["positions"]
+        quantile.desired = data["desired"]
+        return quantile
+
+
+class JobStats(object):
+    """
+    the duration statistics of a job
+    """
+    __slots__ = ('count', 'ewma', 'quantiles')
+
+    def __init__(self):
+        self.count = 0
+        self.ewma = None
+        self.quantiles = [P2Quantile(p) for p in QUANTILES]
+
+    def observe(self, duration, alpha=EWMA_ALPHA):
+        self.count += 1
+        if self.ewma is None:
+            self.ewma = float(duration)
+        else:
+            self.ewma += alpha * (duration - self.ewma)
+        for quantile in self.quantiles:
+            quantile.observe(float(duration))
+
+    def quantile(self, p):
+        for quantile in self.quantiles:
+            if quantile.p == p:
+                return quantile.value
+        return None
+
+    def asdict(self):
+        return dict(count=self.count,
+                    ewma=self.ewma,
+                    quantiles=[quantile.asdict()
+                               for quantile in self.quantiles])
+
+    @classmethod
+    def fromdict(cls, data):
+        stats = cls()
+        stats.count = data["count"]
+        stats.ewma = data["ewma"]
+        stats.quantiles = [P2Quantile.fromdict(quantile)
+                           for quantile in data["quantiles"]]
+        return stats
+
+
+class DurationStats(object):
+    """
+    the duration statistics of the jobs, keyed by the root flow,
+    the job name and its identifier, in fixed memory per job
+    """
+    log = logging.getLogger('stats.DurationStats')
+
+    def __init__(self, cache_path=None):
+        """
+        @param cache_path: the json file storing the statistics,
+                           None to keep them in memory only
+        """
+        self.cache_path = cache_path
+        self.jobs = dict()
+        self.lock = threading.Lock()
+        self._changed = False
+        self._load()
+
+    def _load(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        self.log.info("Load duration statistics from %s" % self.cache_path)
+        try:
+            with open(self.cache_path) as cache_file:
+                data = json.load(cache_file)
+            self.jobs = dict((key, JobStats.fromdict(stats))
+                             for (key, stats) in data.iteritems())
+        except Exception as excp:
+            self.log.error("Unable to load duration statistics from %s: %s"
+                           % (self.cache_path, excp))
+
+    @staticmethod
+    def getKey(flow_name, job):
+        identifier = job.identifier
+        if identifier:
+            return "%s/%s/%s" % (flow_name, job.name,
+                                 json.dumps(identifier, sort_keys=True))
+        return "%s/%s" % (flow_name, job.name)
+
+    def observe(self, flow_name, job, duration):
+        """
+        record the duration of a finished job in a root flow
+        """
+        key = self.getKey(flow_name, job)
+        with self.lock:
+            stats = self.jobs.get(key, None)
+            if stats is None:
+                stats = self.jobs[key] = JobStats()
+            stats.observe(duration)
+            self._changed = True
+
+    def getStats(self, flow_name, job):
+        """
+        @return: the JobStats of a job, None if never observed
+        """
+        return self.jobs.get(self.getKey(flow_name, job), None)
+
+    def planFlow(self, flow_name, flow):
+        """
+        plan the estimate of the remaining time of a flow on a state
+        change, into its summary. The jobs not started yet are walked
+        backwards to get the expected seconds of the longest chain of
+        them after each job, so that the estimate only depends on the
+        running jobs and the current time.
+        """
+        summary = flow.summary
+        if summary.status != "running":
+            summary.estimate = None
+            return
+
+        instances = flow.instances
+        following = [list() for _ in instances]
+        for (index, previous) in enumerate(flow.previous):
+            for prev in previous:
+                following[prev].append(index)
+
+        unknown = False
+        tails = [0] * len(instances)
+        running = list()
+        # the longest chain of the jobs which may start right now
+        ready = 0
+        for index in range(len(instances) - 1, -1, -1):
+            job = instances[index]
+            if job.status not in ("running", None):
+                continue
+            stats = self.getStats(flow_name, job)
+            if stats is None:
+                unknown = True
+            tail = max([tails[i] for i in following[index]
+                        if instances[i].status is None] or [0])
+            if job.status is None:
+                tails[index] = (stats.ewma if stats else 0) + tail
+                if not any(instances[i].status in ("running", None)
+                           for i in flow.previous[index]):
+                    ready = max(ready, tails[index])
+            else:
+                running.append((index,
+                                job.started,
+                                stats.ewma if stats else None,
+                                stats.quantile(LATE_QUANTILE)
+                                if stats else None,
+                                tail))
+        summary.estimate = (unknown, ready, running)
+
+    @staticmethod
+    def estimateFlow(flow, now=None):
+        """
+        estimate the remaining seconds of a running flow from its plan,
+        predicting the finish time of each running job from its expected
+        duration, followed by the longest chain of the jobs after it
+        @return: (the remaining seconds, None if the flow is not running
+                  or a job still to run was never observed,
+                  the progress in percent of the running jobs by index,
+                  the indexes of the running jobs which are late)
+        """
+        progress = dict()
+        late = list()
+        estimate = flow.summary.estimate
+        if flow.summary.status != "running" or estimate is None:
+            return (None, progress, late)
+
+        if now is None:
+            now = time.time()
+        (unknown, ready, running) = estimate
+        finish = now + ready
+        for (index, started, expected, limit, tail) in running:
+            started = started or now
+            if expected:
+                progress[index] = min(99, int(100 * (now - started) /
+                                              expected))
+            if limit is not None and now - started > limit:
+                late.append(index)
+            finish = max(finish, max(now, started + (expected or 0)) + tail)
+        if unknown:
+            return (None, progress, late)
+        return (int(finish - now), progress, late)
+
+    def flush(self):
+        """
+        write the statistics into the cache file
+        """
+        if not self.cache_path:
+            return
+        with self.lock:
+            if not self._changed:
+                return
+            data = dict((key, stats.asdict())
+                        for (key, stats) in self.jobs.iteritems())
+            self._changed = False
+        tmp_path = "%s.%d.tmp" % (self.cache_path, os.getpid())
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(data, cache_file, separators=(',', ':'))
+        os.rename(tmp_path, self.cache_path)
@@ -9,6 +9,14 @@ class DuplicatedException(Exception):
     pass
 
 
+class CircularLabelException(Exception):
+    pass
+
+
+class JenkinsUnavailableException(Exception):
+    pass
+
+
 def setup_logging():
     logging.basicConfig(level=logging.DEBUG,
                         format='%(asctime)s %(levelname)s %(name)s: '
@@ -1,5 +1,6 @@
 from flask import Flask
 from reflatus.runner import Runner
+import atexit
 
 
 class Reflatus(Flask):
@@ -23,8 +24,12 @@ class Reflatus(Flask):
                                        instance_relative_config=instance_relative_config)
         self.beconfig = beconfig
         self._startRunner()
+        self.flows = self.runner.flows
         self.flow_map = self.runner.flow_map
 
     def _startRunner(self):
         self.runner = Runner(self.beconfig)
         self.runner.start()
+        # stop the runner gracefully when the process exits,
+        # e.g. on mod_wsgi worker recycling
+        atexit.register(self.runner.stop)
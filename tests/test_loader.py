@@ -0,0 +1,89 @@
+"""
+test the expansion of the labeled flows
+"""
+import unittest
+from reflatus.loader import Loader, Labeled, Parallel
+from reflatus.utils import CircularLabelException
+
+
+def flow(name, jobs, label=False):
+    return dict(name=name, label=label, jobs=jobs)
+
+
+def job(name, label=False):
+    return dict(name=name, label=label)
+
+
+class LabelExpansionTest(unittest.TestCase):
+
+    def load(self, *flows):
+        return Loader(None).getConfigFromData(dict(flows=list(flows)))
+
+    def test_nested_labels(self):
+        (flows, flow_map) = self.load(
+            flow("root", [dict(serial=[job("a"), job("outer", True),
+                                       job("d")])]),
+            flow("outer", [dict(serial=[job("b"), job("inner", True)])],
+                 label=True),
+            flow("inner", [dict(parallel=[job("c1"), job("c2")])],
+                 label=True))
+
+        # the labeled flows are not flows by themselves
+        self.assertEqual(sorted(flows), ["root"])
+        root = flows["root"]
+        self.assertEqual([instance.name for instance in root.instances],
+                         ["a", "b", "c1", "c2", "d"])
+
+        outer = root.jobs[0][1]
+        self.assertIsInstance(outer, Labeled)
+        self.assertEqual(outer.label, "outer")
+        inner = outer[0][1]
+        self.assertIsInstance(inner, Labeled)
+        self.assertEqual(inner.label, "inner")
+        self.assertIsInstance(inner[0], Parallel)
+        self.assertEqual(root.instances[2].labeledBy, "inner")
+
+        # c1 and c2 run after b, d after both of them
+        self.assertEqual(root.previous, [[], [0], [1], [1], [2, 3]])
+        self.assertEqual(len(flow_map["root"]), 5)
+
+    def test_label_shared_by_flows(self):
+        (flows, _) = self.load(
+            flow("one", [dict(serial=[job("shared", True)])]),
+            flow("two", [dict(serial=[job("x"), job("shared", True)])]),
+            flow("shared", [dict(serial=[job("s")])], label=True))
+
+        one = flows["one"].instances[0]
+        two = flows["two"].instances[1]
+        # the definitions are shared, the instances are not
+        self.assertIs(one.definition, two.definition)
+        self.assertIsNot(one, two)
+        two.update(dict(number=1), "running", None)
+        self.assertEqual(one.status, None)
+
+    def test_circular_label(self):
+        loader = Loader(None)
+        loader._parse(dict(flows=[
+            flow("root", [dict(serial=[job("a", True)])]),
+            flow("a", [dict(serial=[job("b", True)])], label=True),
+            flow("b", [dict(serial=[job("a", True)])], label=True)]))
+        loader._expanded = dict()
+        with self.assertRaises(CircularLabelException) as context:
+            loader._expand("root", ["root"])
+        self.assertIn("a -> b -> a", str(context.exception))
+
+    def test_circular_label_is_skipped(self):
+        (flows, _) = self.load(
+            flow("root", [dict(serial=[job("loop", True)])]),
+            flow("loop", [dict(serial=[job("loop", True)])], label=True),
+            flow("other", [dict(serial=[job("x")])]))
+        self.assertEqual(sorted(flows), ["other"])
+
+    def test_unknown_label_is_skipped(self):
+        (flows, _) = self.load(
+            flow("root", [dict(serial=[job("missing", True)])]))
+        self.assertEqual(flows, dict())
+
+
+if __name__ == "__main__":
+    unittest.main()
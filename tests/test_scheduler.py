@@ -0,0 +1,133 @@
+"""
+test the stale event detection and the flow gates
+"""
+import time
+import threading
+import unittest
+from reflatus.scheduler import Event, Watermarks, FlowGates
+
+
+def event(topic, name, number):
+    return Event(topic, dict(name=name, build=dict(number=number)), 0)
+
+
+class WatermarksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.watermarks = Watermarks(window=4)
+
+    def test_root_flow_stale(self):
+        self.assertTrue(self.watermarks.observe(
+            event("onStarted", "flow", 2), True, ["job"]))
+        self.assertFalse(self.watermarks.observe(
+            event("onStarted", "flow", 1), True, ["job"]))
+        self.assertFalse(self.watermarks.observe(
+            event("onFinalized", "flow", 1), True, ["job"]))
+        self.assertEqual(self.watermarks.getFlowBuild("flow"), 2)
+
+    def test_duplicated_phases(self):
+        self.assertTrue(self.watermarks.observe(
+            event("onStarted", "job", 1), False))
+        self.assertFalse(self.watermarks.observe(
+            event("onStarted", "job", 1), False))
+        self.assertTrue(self.watermarks.observe(
+            event("onFinalized", "job", 1), False))
+        self.assertFalse(self.watermarks.observe(
+            event("onFinalized", "job", 1), False))
+        # a build never goes back to an earlier phase
+        self.assertFalse(self.watermarks.observe(
+            event("onStarted", "job", 1), False))
+
+    def test_window_floor(self):
+        for number in range(1, 6):
+            self.assertTrue(self.watermarks.observe(
+                event("onStarted", "job", number), False))
+        # the build 1 is out of the window of 4 builds
+        self.assertFalse(self.watermarks.observe(
+            event("onFinalized", "job", 1), False))
+        self.assertTrue(self.watermarks.observe(
+            event("onFinalized", "job", 2), False))
+
+    def test_snapshot_drops_older_job_builds(self):
+        self.watermarks.register("flow", ["job"])
+        self.assertTrue(self.watermarks.observe(
+            event("onStarted", "job", 3), False))
+        self.assertTrue(self.watermarks.observe(
+            event("onStarted", "flow", 1), True, ["job"]))
+        # the build 3 started before the flow
+        self.assertFalse(self.watermarks.observe(
+            event("onFinalized", "job", 3), False))
+        self.assertTrue(self.watermarks.observe(
+            event("onStarted", "job", 4), False))
+        self.assertTrue(self.watermarks.observe(
+            event("onFinalized", "job", 4), False))
+
+    def test_snapshot_of_shared_job(self):
+        self.watermarks.register("flow1", ["job"])
+        self.watermarks.register("flow2", ["job"])
+        self.assertTrue(self.watermarks.observe(
+            event("onStarted", "job", 3), False))
+        self.assertTrue(self.watermarks.observe(
+            event("onStarted", "flow1", 1), True, ["job"]))
+        # the flow2 did not start yet, the build 3 may belong to it
+        self.assertTrue(self.watermarks.observe(
+            event("onFinalized", "job", 3), False))
+        self.assertTrue(self.watermarks.observe(
+            event("onStarted", "job", 4), False))
+        self.assertTrue(self.watermarks.observe(
+            event("onStarted", "flow2", 1), True, ["job"]))
+        # the build 4 started after the flow1, it may belong to it
+        self.assertTrue(self.watermarks.observe(
+            event("onFinalized", "job", 4), False))
+        self.assertTrue(self.watermarks.observe(
+            event("onStarted", "job", 5), False))
+        self.assertTrue(self.watermarks.observe(
+            event("onStarted", "flow1", 2), True, ["job"]))
+        self.assertTrue(self.watermarks.observe(
+            event("onStarted", "flow2", 2), True, ["job"]))
+        self.assertFalse(self.watermarks.observe(
+            event("onFinalized", "job", 5), False))
+
+    def test_unregistered_job(self):
+        self.assertTrue(self.watermarks.observe(
+            event("onStarted", "flow", 1), True, ["job"]))
+        self.assertTrue(self.watermarks.observe(
+            event("onStarted", "other", 1), False))
+
+
+class FlowGatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gates = FlowGates()
+
+    def test_open_flow(self):
+        self.assertTrue(self.gates.wait("flow", 0))
+
+    def test_wait_timeout(self):
+        self.gates.close("flow")
+        started = time.time()
+        self.assertFalse(self.gates.wait("flow", 0.1))
+        self.assertTrue(time.time() - started >= 0.1)
+        # the other flows are not blocked
+        self.assertTrue(self.gates.wait("other", 0))
+
+    def test_nested_cleanups(self):
+        self.gates.close("flow")
+        self.gates.close("flow")
+        self.gates.open("flow")
+        self.assertFalse(self.gates.wait("flow", 0))
+        self.gates.open("flow")
+        self.assertTrue(self.gates.wait("flow", 0))
+
+    def test_wait_until_open(self):
+        self.gates.close("flow")
+        timer = threading.Timer(0.1, self.gates.open, ("flow",))
+        timer.start()
+        try:
+            self.assertTrue(self.gates.wait("flow", 5))
+        finally:
+            timer.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
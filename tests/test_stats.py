@@ -0,0 +1,145 @@
+"""
+test the streaming duration statistics and the flow ETA
+"""
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from reflatus.loader import Loader
+from reflatus.stats import P2Quantile, JobStats, DurationStats
+
+
+class P2QuantileTest(unittest.TestCase):
+
+    def assertQuantile(self, samples, p, tolerance):
+        quantile = P2Quantile(p)
+        for sample in samples:
+            quantile.observe(sample)
+        exact = sorted(samples)[int(p * len(samples))]
+        self.assertAlmostEqual(quantile.value, exact, delta=tolerance)
+
+    def test_uniform(self):
+        rand = random.Random(1)
+        samples = [rand.uniform(0, 100) for _ in range(10000)]
+        self.assertQuantile(samples, 0.5, 1)
+        self.assertQuantile(samples, 0.9, 1)
+
+    def test_exponential(self):
+        rand = random.Random(2)
+        samples = [rand.expovariate(1 / 60.0) for _ in range(20000)]
+        self.assertQuantile(samples, 0.5, 2)
+        self.assertQuantile(samples, 0.9, 5)
+
+    def test_few_samples(self):
+        quantile = P2Quantile(0.5)
+        self.assertEqual(quantile.value, None)
+        for sample in (30, 10, 20):
+            quantile.observe(sample)
+        self.assertEqual(quantile.value, 20)
+
+    def test_roundtrip(self):
+        quantile = P2Quantile(0.9)
+        for sample in range(100):
+            quantile.observe(sample)
+        restored = P2Quantile.fromdict(quantile.asdict())
+        for sample in range(100, 200):
+            quantile.observe(sample)
+            restored.observe(sample)
+        self.assertEqual(restored.value, quantile.value)
+
+
+class JobStatsTest(unittest.TestCase):
+
+    def test_ewma(self):
+        stats = JobStats()
+        stats.observe(10)
+        self.assertEqual(stats.ewma, 10)
+        stats.observe(20, alpha=0.5)
+        self.assertEqual(stats.ewma, 15)
+        self.assertEqual(stats.count, 2)
+
+
+class DurationStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        data = dict(flows=[dict(name="flow", jobs=[
+            dict(serial=[dict(name="a")]),
+            dict(parallel=[dict(name="b"), dict(name="c")]),
+            dict(serial=[dict(name="d")])])])
+        (flows, _) = Loader(None).getConfigFromData(data)
+        self.flow = flows["flow"]
+        self.stats = DurationStats()
+
+    def observe(self, durations):
+        for (job, duration) in zip(self.flow.instances, durations):
+            self.stats.observe("flow", job, duration)
+
+    def start(self, now):
+        self.flow.summary.flowChanged(dict(number=1), "running", now)
+        self.stats.planFlow("flow", self.flow)
+
+    def update(self, index, status, started=None):
+        self.flow.instances[index].update(dict(number=1), status, None,
+                                          started)
+        self.stats.planFlow("flow", self.flow)
+
+    def test_not_running(self):
+        self.observe([10, 20, 30, 40])
+        self.stats.planFlow("flow", self.flow)
+        self.assertEqual(DurationStats.estimateFlow(self.flow, 0),
+                         (None, dict(), list()))
+
+    def test_eta(self):
+        self.observe([10, 20, 30, 40])
+        self.start(100)
+        # a, then the longest of b and c, then d
+        self.assertEqual(DurationStats.estimateFlow(self.flow, 100)[0], 80)
+
+        self.update(0, "running", 100)
+        (eta, progress, late) = DurationStats.estimateFlow(self.flow, 105)
+        self.assertEqual(eta, 75)
+        self.assertEqual(progress, {0: 50})
+        self.assertEqual(late, [])
+
+        self.update(0, "success")
+        self.update(1, "running", 110)
+        self.update(2, "success")
+        # d waits for b, which is expected to run 20 seconds
+        self.assertEqual(DurationStats.estimateFlow(self.flow, 115)[0], 55)
+
+    def test_late_job(self):
+        self.observe([10, 20, 30, 40])
+        self.start(100)
+        self.update(0, "running", 100)
+        (eta, progress, late) = DurationStats.estimateFlow(self.flow, 130)
+        # a takes longer than expected, the rest follows it
+        self.assertEqual(eta, 70)
+        self.assertEqual(progress, {0: 99})
+        self.assertEqual(late, [0])
+
+    def test_unknown_job(self):
+        self.observe([10, 20, 30])
+        self.start(100)
+        self.assertEqual(DurationStats.estimateFlow(self.flow, 100)[0], None)
+        # d is the job never observed
+        self.update(3, "success")
+        self.assertEqual(DurationStats.estimateFlow(self.flow, 100)[0], 40)
+
+    def test_flush(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cache_path = os.path.join(tmp_dir, "stats.json")
+            stats = DurationStats(cache_path)
+            stats.observe("flow", self.flow.instances[0], 10)
+            stats.flush()
+            restored = DurationStats(cache_path)
+            job_stats = restored.getStats("flow", self.flow.instances[0])
+            self.assertEqual(job_stats.count, 1)
+            self.assertEqual(job_stats.ewma, 10)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()